@@ -29,7 +29,32 @@ import mrbus
 import sys
 import time
 
+# Functions are kept as a 29 bit integer, bit n for function n.  For each byte value, this lists which
+# of its bits are set, so the functions that changed can be found without looking at the other 28.
+FUNCTION_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value & (1 << bit)) for value in range(256))
+
+def functionBitsFromList(functions):
+   """Converts a list of function states (as the command stations return them) into a 29 bit integer."""
+   bits = 0
+   for i in range(min(29, len(functions))):
+      if functions[i]:
+         bits |= (1 << i)
+   return bits
+
+def packetAddress(pkt):
+   """Returns the locomotive address in a ProtoThrottle status packet and whether it's a long address."""
+   addr = pkt.data[0] * 256 + pkt.data[1]
+   if 0 != (addr & 0x8000):
+      return (addr & 0x007F, False)
+   return (addr, True)
+
+def isEmergencyStop(pkt):
+   """Returns True if a ProtoThrottle status packet has its speed set to the emergency stop code."""
+   return (pkt.data[2] & 0x7F) == 1
+
 class MRBusThrottle:
+   __slots__ = ('locAddr', 'locAddrLong', 'locSpeed', 'locDirection', 'locObjID', 'locEStop', 'locFunctions',
+                'throttleAddr', 'lastUpdate', 'lastData')
    
    def __init__(self, addr):
       self.locAddr = 0
@@ -41,11 +66,32 @@ class MRBusThrottle:
       self.locFunctions = None
       self.throttleAddr = addr
       self.lastUpdate = 0
+      # Payload of the last status packet that was completely applied - see isRepeat()
+      self.lastData = None
       return
       
    def getLastUpdateTime(self):
       return self.lastUpdate
+
+   def isRepeat(self, pkt):
+      """Returns True if pkt carries exactly the same state as the last packet update() fully
+         applied, in which case passing it to update() would only refresh the timestamp."""
+      return pkt.data == self.lastData
+
+   def touch(self, now):
+      self.lastUpdate = now
    
+   def emergencyStop(self, cmdStn, pkt):
+      """Sends the emergency stop in pkt straight away if it's for the locomotive this throttle already has, and
+         returns True if it did.  update() doesn't send it again when it gets to the same packet.  Anything that
+         needs more than a stop, like acquiring a different locomotive, is left to update()."""
+      if self.lastUpdate == 0 or self.locEStop == 1 or packetAddress(pkt) != (self.locAddr, self.locAddrLong):
+         return False
+      print("MRBusThrottle (0x%02X): Set ESTOP loco %d" % (self.throttleAddr, self.locAddr))
+      cmdStn.locomotiveEmergencyStop(self.locObjID)
+      self.locEStop = 1
+      return True
+
    def disconnect(self, cmdStn):
       cmdStn.locomotiveSpeedSet(self.locObjID, 0, 0)
       cmdStn.locomotiveDisconnect(self.locObjID)
@@ -57,12 +103,7 @@ class MRBusThrottle:
       
       # print "MRBusThrottle (0x%02X): UPDATE loco %d" % (self.throttleAddr, self.locAddr)
       
-      addr = pkt.data[0] * 256 + pkt.data[1]
-      if 0 != (addr & 0x8000):
-         self.locAddrLong = False
-         addr = addr & 0x007F
-      else:
-         self.locAddrLong = True
+      (addr, addrLong) = packetAddress(pkt)
          
       speed = pkt.data[2] & 0x7F
       if 1 == speed:
@@ -79,9 +120,18 @@ class MRBusThrottle:
       else:
          direction = 1
 
-      if (addr != self.locAddr):
+      # Short and long addresses with the same number are different locomotives
+      if (addr != self.locAddr or addrLong != self.locAddrLong):
+         # locAddr only changes once the new locomotive is ours - see emergencyStop()
+         locObjID = cmdStn.locomotiveObjectGet(addr, self.throttleAddr, addrLong)
+         if locObjID is None:
+            # The command station is still looking it up, or didn't answer in time - try again on the next packet
+            print("MRBusThrottle (0x%02X): Couldn't acquire locomotive %d yet" % (self.throttleAddr, addr))
+            self.lastUpdate = time.time()
+            return
+         self.locObjID = locObjID
          self.locAddr = addr
-         self.locObjID = cmdStn.locomotiveObjectGet(self.locAddr, self.throttleAddr, self.locAddrLong)
+         self.locAddrLong = addrLong
          print("MRBusThrottle (0x%02X): Acquiring new locomotive %d - objID = %s" % (self.throttleAddr, self.locAddr, self.locObjID))
       
       # Only send ESTOP if we just moved into that state
@@ -102,37 +152,42 @@ class MRBusThrottle:
       # The LNWI / WiThrottle support this, others may in the future
       if self.locFunctions is None:
          try:
-            self.locFunctions = cmdStn.locomotiveFunctionsGet(self.locObjID)
+            locFunctions = cmdStn.locomotiveFunctionsGet(self.locObjID)
             print("MRBusThrottle (0x%02X): Got loco [%d] functions from cmd station" % (self.throttleAddr, self.locAddr))
-            print(self.locFunctions)
+            print(locFunctions)
+            if locFunctions is not None:
+               self.locFunctions = functionBitsFromList(locFunctions)
          except Exception as e:
             print("MRBusThrottle (0x%02X): Exception in locomotiveFunctionsGet() for loco [%d]" % (self.throttleAddr, self.locAddr))
-            self.locFunctions = [ 0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0 ]
+            self.locFunctions = 0
+
+      # The command station may still be acquiring the locomotive - compare functions on a later packet once it knows them
+      if self.locFunctions is None:
+         self.lastUpdate = time.time()
+         return
          
-      functions = [ 0,0,0,0,0,0,0,0,0,0,
-                       0,0,0,0,0,0,0,0,0,0,
-                       0,0,0,0,0,0,0,0,0 ]
-      
-      for i in range(29):
-         if i >= 0 and i < 8:
-            if pkt.data[6] & (1<<i):
-               functions[i] = 1
-         elif i >= 8 and i < 16:
-            if pkt.data[5] & (1<<(i-8)):
-               functions[i] = 1
-         elif i >= 16 and i < 24:
-            if pkt.data[4] & (1<<(i-16)):
-               functions[i] = 1
-         elif i >= 24 and i < 29:
-            if pkt.data[3] & (1<<(i-24)):
-               functions[i] = 1
-
-      for i in range(29):
-         if functions[i] != self.locFunctions[i]:
-            print("MRBusThrottle (0x%02X): Set loco [%d] function [%d] to [%d]" % (self.throttleAddr, self.locAddr, i, functions[i]))
-            cmdStn.locomotiveFunctionSet(self.locObjID, i, functions[i])
+      # F0-F7 are in data[6], F8-F15 in data[5], F16-F23 in data[4] and F24-F28 in the bottom of data[3]
+      functions = ((pkt.data[3] & 0x1F) << 24) | (pkt.data[4] << 16) | (pkt.data[5] << 8) | pkt.data[6]
+      changed = functions ^ self.locFunctions
+
+      if changed:
+         changedFunctions = { }
+         for byteNum in range(4):
+            for bit in FUNCTION_BYTE_BITS[(changed >> (byteNum * 8)) & 0xFF]:
+               i = byteNum * 8 + bit
+               funcVal = (functions >> i) & 1
+               print("MRBusThrottle (0x%02X): Set loco [%d] function [%d] to [%d]" % (self.throttleAddr, self.locAddr, i, funcVal))
+               changedFunctions[i] = funcVal
+
+         # Send every change from this packet as one command if the command station can take it
+         if len(changedFunctions) > 1 and cmdStn.supportsFunctionDictSet:
+            cmdStn.locomotiveFunctionDictSet(self.locObjID, changedFunctions)
+         else:
+            for (funcNum, funcVal) in changedFunctions.items():
+               cmdStn.locomotiveFunctionSet(self.locObjID, funcNum, funcVal)
 
       self.locFunctions = functions
+      self.lastData = pkt.data
       
       self.lastUpdate = time.time()
       
@@ -37,7 +37,9 @@
 import sys
 import time
 import traceback
+import heapq
 import socket
+import selectors
 import argparse
 import configparser
 import logging
@@ -49,10 +51,16 @@ import MRBusThrottle
 import netUtils
 
 import JMRIClock
+import timerQueue
 
 import datetime
 
 statusInterval = 1
+errorLightInterval = 0.5
+pktLightInterval = 4
+pingInterval = 5
+cmdStnUpdateInterval = 0.5
+throttleTimeout = 60
 searchDelay = 0.03
 baseAddress = 0xD0
 
@@ -76,11 +84,17 @@ dccConnectionMode = ""
 serverIP = None
 serverPort = None
 pingServer = False
+# Number of connections to open to a WiThrottle server - each one handles up to 32 throttles
+serverConnections = 1
 # These are for the JMRI websocket for fast clock connections
 useJMRIClock = False
 webPort = None
 timeZoneOffset = None
 displayTime12h = False
+# Time from receiving an emergency stop to sending it to the command station, in milliseconds
+estopCount = 0
+estopLatencyTotal = 0.0
+estopLatencyMax = 0.0
 
 def getMillis():
    return time.time() * 1000.0
@@ -135,6 +149,193 @@ def serverFind(timeout, port, mrbee):
    mrbee.setXbeeLED('D8', False);
    return None
 
+def sendStatusPackets():
+   """Broadcasts the bridge version packet, and the fast clock time if we have a JMRI clock."""
+   mrbee.sendframe(statusFrame)
+   if operatingMode == "JMRI" and useJMRIClock == True: 
+      hrs = timeSource.getHours()
+      mins = timeSource.getMinutes()
+      
+#      print "JMRI timeSource reports hrs=%d, min=%d" % (hrs, min)
+      if ( hrs >= 0 and hrs < 24 and mins >= 0 and mins < 60 ):
+         timeFlags = 0x01   # Display fast time
+         if displayTime12h:
+            timeFlags |= 0x08 # display fast time in AMPM
+            
+         timePacket = [ ord('T'), 0, 0, 0, timeFlags, hrs, mins, 0, 0, 0, 0 ,0 ,0 ]
+         mrbee.sendpkt(0xFF, timePacket)
+
+def radioReceive():
+   """Handles every packet the radio has waiting.  Called whenever the serial port is readable.
+      Emergency stops are sent to the command station ahead of everything else that arrived with them."""
+   global errorLightOn, pktLightOn, lastPktTime
+
+   throttlePkts = [ ]
+   stopPkts = { }
+
+   # Pull everything the radio has already received so a burst of packets is handled in one pass
+   for pkt in mrbee.getpkts():
+      if pkt.src == baseAddress:
+         print("Conflicting ProtoThrottle base station detected!!!\nTurning Error LED on\n")
+         errorLightOn = True
+         mrbee.setXbeeLED('D6', errorLightOn)
+         timers.schedule('errorLight', time.time() + errorLightInterval)
+
+
+      # Bypass anything that doesn't look like a throttle packet
+      if pkt.cmd != 0x53 or len(pkt.data) != 9 or baseAddress != pkt.dest:
+         continue
+
+      if MRBusThrottle.isEmergencyStop(pkt):
+         stopPkts[pkt.src] = pkt
+
+      throttlePkts.append(pkt)
+
+   if len(throttlePkts) != 0:
+      stopped = emergencyStopsProcess(stopPkts)
+      throttlePacketsProcess(throttlePkts, stopped)
+      lastPktTime = time.time()
+      if False == pktLightOn:
+         print("Turning ProtoThrottle packet received LED on")
+         pktLightOn = True
+         mrbee.setXbeeLED('D7', pktLightOn)
+         timers.schedule('pktLight', lastPktTime + pktLightInterval)
+
+def emergencyStopsProcess(stopPkts):
+   """Sends the emergency stops the radio spotted ahead of anything else the same burst has for the
+      command station.  Returns the stop packets that actually went out, keyed by throttle address."""
+   global estopCount, estopLatencyTotal, estopLatencyMax
+
+   stopped = { }
+   for (src, pkt) in stopPkts.items():
+      throttle = throttles[src]
+      if throttle is None or not throttle.emergencyStop(cmdStn, pkt):
+         continue
+      stopped[src] = pkt
+
+      # Timed from the serial read that completed the packet
+      latency = (time.time() - pkt.rxTime) * 1000
+      estopCount += 1
+      estopLatencyTotal += latency
+      estopLatencyMax = max(estopLatencyMax, latency)
+      print("PT-BRIDGE: E-stop from throttle 0x%02X sent %.1f ms after it was received (%d sent, %.1f ms average, %.1f ms worst)" % (src, latency, estopCount, estopLatencyTotal / estopCount, estopLatencyMax))
+
+   return stopped
+
+def throttlePacketsProcess(pkts, stopped):
+   """Passes each ProtoThrottle packet on to the MRBusThrottle object for the throttle that sent it.
+      stopped holds the emergency stops already sent for this burst - anything that throttle sent
+      before its stop for the same locomotive still has its functions applied, but takes its speed
+      and direction from the stop."""
+   currentTime = time.time()
+   updated = False
+   for pkt in pkts:
+      stopPkt = stopped.get(pkt.src)
+      if stopPkt is pkt:
+         del stopped[pkt.src]
+      elif stopPkt is not None and pkt.data[0:2] == stopPkt.data[0:2]:
+         pkt = mrbus.packet(pkt.dest, pkt.src, pkt.cmd, pkt.data[0:2] + stopPkt.data[2:3] + pkt.data[3:], pkt.rxTime)
+      throttle = throttles[pkt.src]
+      # Create a MRBusThrottle object for every new Protothrottle that shows up
+      if throttle is None:
+         throttle = throttles[pkt.src] = MRBusThrottle.MRBusThrottle(pkt.src)
+         heapq.heappush(throttleExpiry, (currentTime + throttleTimeout, pkt.src))
+      # Throttles resend their whole state constantly - a packet identical to the last one only
+      # shows the throttle is still there
+      elif throttle.isRepeat(pkt):
+         throttle.touch(currentTime)
+         continue
+#      print("PT-BRIDGE: Processing packet from throttle %02X" % (pkt.src))
+      throttle.update(cmdStn, pkt)
+      updated = True
+#      print("PT-BRIDGE: Done processing packet from throttle %02X" % (pkt.src))
+
+   # Only the newest speed from the whole burst goes out for each locomotive
+   if updated:
+      cmdStnFlushLater(cmdStn.flush())
+
+def throttleTimeoutSweep(currentTime):
+   """Disconnects and forgets any throttle we haven't heard from in throttleTimeout seconds.
+      Every throttle has one entry in throttleExpiry, but packets don't move it - an entry that
+      comes due for a throttle heard from since is just pushed back to its real deadline, so
+      this only ever looks at throttles that were close to timing out."""
+   expired = False
+
+   while len(throttleExpiry) != 0 and throttleExpiry[0][0] < currentTime:
+      (deadline, key) = heapq.heappop(throttleExpiry)
+      throttle = throttles[key]
+      deadline = max(deadline, throttle.getLastUpdateTime() + throttleTimeout)
+      if deadline >= currentTime:
+         heapq.heappush(throttleExpiry, (deadline, key))
+         continue
+
+      print("Throttle address 0x%02X has timed out, removing" % key)
+      throttles[key] = None
+      throttle.disconnect(cmdStn)
+      expired = True
+      print("Throttle disconnected")
+
+   if expired:
+      cmdStnFlushLater(cmdStn.flush())
+
+def cmdStnFlushLater(delay):
+   """Arranges for the command station to be flushed again in delay seconds, once its rate limiter will
+      let out the commands it held back.  Nothing is scheduled if it didn't hold any back (delay is 0)."""
+   if delay > 0:
+      timers.schedule('flush', time.time() + delay)
+
+def timerExpired(timerName):
+   """Does whatever periodic work timerName stands for and reschedules it if it repeats."""
+   global errorLightOn, pktLightOn
+
+   currentTime = time.time()
+
+   if timerName == 'status':
+#      print("PT-BRIDGE: Sending status packet")
+      sendStatusPackets()
+      timers.schedule('status', currentTime + statusInterval)
+
+   elif timerName == 'errorLight':
+      print("Turning Error LED off")
+      errorLightOn = False
+      mrbee.setXbeeLED('D6', errorLightOn)
+
+   elif timerName == 'pktLight':
+      # Packets keep pushing lastPktTime out, so only turn the light off once they've stopped
+      if currentTime < lastPktTime + pktLightInterval:
+         timers.schedule('pktLight', lastPktTime + pktLightInterval)
+      else:
+         print("PT-BRIDGE: Turning ProtoThrottle received LED off")
+         pktLightOn = False
+         mrbee.setXbeeLED('D7', pktLightOn)
+
+   elif timerName == 'ping':
+      serverPing()
+      timers.schedule('ping', currentTime + pingInterval)
+
+   elif timerName == 'cmdStn':
+      cmdStnFlushLater(cmdStn.update())
+      timers.schedule('cmdStn', currentTime + cmdStnUpdateInterval)
+
+   elif timerName == 'flush':
+      cmdStnFlushLater(cmdStn.flush())
+
+   elif timerName == 'throttles':
+      throttleTimeoutSweep(currentTime)
+      timers.schedule('throttles', currentTime + 1)
+
+def serverPing():
+   pingSuccess = False
+   pingRetries = 0
+   while pingSuccess is not True and pingRetries < 3:
+      pingSuccess = pingSuccess or netUtils.ping(foundIP)
+      pingRetries += 1
+
+   if pingSuccess is not True:
+       raise Exception("Server unreachable")
+   
+   print("PT-BRIDGE: Ping command station successful")
+
 # Big loop - runs as long as the program is alive
 while 1:
 
@@ -229,6 +430,14 @@ while 1:
          except:
             pass
 
+         try:
+            serverConnections = parser.getint("configuration", "serverConnections")
+            if serverConnections < 1:
+               serverConnections = 1
+            print("Using %d server connections" % (serverConnections))
+         except:
+            serverConnections = 1
+
 
          try:
             if 0 != int(parser.get("configuration", "useJMRIClock")):
@@ -285,7 +494,9 @@ while 1:
    # Initialization loop - runs until both ESU and MRBus are connected
    while 1:
       try:
-         throttles = { }
+         # Indexed by MRBus source address, with a min-heap of (deadline, address) for timeouts
+         throttles = [ None ] * 256
+         throttleExpiry = [ ]
          print("PT-BRIDGE: Looking for XBee / MRBus interface")
 
          if mrbee is not None:
@@ -385,7 +596,7 @@ while 1:
                continue
 
             print("PT-BRIDGE: Trying %s server connection" % (operatingMode))
-            cmdStn = withrottle.WiThrottleConnection()
+            cmdStn = withrottle.WiThrottlePool(serverConnections)
             cmdStn.connect(foundIP, serverPort, operatingMode)
             
             if useJMRIClock == True:
@@ -421,14 +632,30 @@ while 1:
          time.sleep(2)
 
 
-   lastStatusTime = time.time()
-   lastErrorTime = lastStatusTime
-   lastPktTime = lastStatusTime
-   lastPingTime = lastStatusTime
+   # The version packet only depends on the configuration, so encode it once per connection
+   statusPacket = [ ord('v'), 0x80, gitver[2], gitver[1], gitver[0], 1, 0 ] + getInterfaceTypeByteArray(bridgeTypeStr)
+   statusFrame = mrbee.encodepkt(0xFF, statusPacket)
+
+   lastPktTime = time.time()
 
    errorLightOn = False
    pktLightOn = False
 
+   # Everything periodic runs off the timer queue, so the loop below can sleep in select()
+   # until either the radio or the command station has data or the next timer is due
+   timers = timerQueue.TimerQueue()
+   timers.schedule('status', lastPktTime)
+   timers.schedule('cmdStn', lastPktTime)
+   timers.schedule('throttles', lastPktTime + 1)
+   if pingServer is True:
+      timers.schedule('ping', lastPktTime + pingInterval)
+
+   selector = selectors.DefaultSelector()
+   selector.register(mrbee, selectors.EVENT_READ, 'radio')
+   # A WiThrottle pool has one socket per connection
+   for fd in cmdStn.filenos():
+      selector.register(fd, selectors.EVENT_READ, 'cmdStn')
+
    print("")
    print(" ENDING CONNECTION PHASE")
    print("-----------------------------------------------")
@@ -439,99 +666,18 @@ while 1:
    # Main Run Loop - runs until something weird happens
    while 1:
       try:
+         for (key, events) in selector.select(timers.timeout(time.time())):
+            if key.data == 'radio':
+               radioReceive()
+            else:
+               cmdStnFlushLater(cmdStn.update())
 
-         currentMillis = getMillis()
-         
-         if currentMillis > (lastErrorTime + 500) and errorLightOn:
-            print("Turning Error LED off")
-            errorLightOn = False
-            mrbee.setXbeeLED('D6', errorLightOn)
-
-         if currentMillis > ( lastPktTime + 4000) and pktLightOn:
-            print("PT-BRIDGE: Turning ProtoThrottle received LED off")
-            pktLightOn = False
-            mrbee.setXbeeLED('D7', pktLightOn)
-
-         if pingServer is True and (currentMillis > (lastPingTime + 5000)):
-             pingSuccess = False
-             pingRetries = 0
-             while pingSuccess is not True and pingRetries < 3:
-                pingSuccess = pingSuccess or netUtils.ping(foundIP)
-                pingRetries += 1
-
-             if pingSuccess is not True:
-                 raise Exception("Server unreachable")
-             
-             lastPingTime = currentMillis
-             print("PT-BRIDGE: Ping command station successful")
-             
-
-         pkt = mrbee.getpkt()
-
-         if time.time() > lastStatusTime + statusInterval:
-#            print("PT-BRIDGE: Sending status packet")
-            statusPacket = [ ord('v'), 0x80, gitver[2], gitver[1], gitver[0], 1, 0 ] + getInterfaceTypeByteArray(bridgeTypeStr)
-            mrbee.sendpkt(0xFF, statusPacket)
-            if operatingMode == "JMRI" and useJMRIClock == True: 
-               hrs = timeSource.getHours()
-               mins = timeSource.getMinutes()
-               
-#               print "JMRI timeSource reports hrs=%d, min=%d" % (hrs, min)
-               if ( hrs >= 0 and hrs < 24 and mins >= 0 and mins < 60 ):
-                  timeFlags = 0x01   # Display fast time
-                  if displayTime12h:
-                     timeFlags |= 0x08 # display fast time in AMPM
-                     
-                  timePacket = [ ord('T'), 0, 0, 0, timeFlags, hrs, mins, 0, 0, 0, 0 ,0 ,0 ]
-                  mrbee.sendpkt(0xFF, timePacket)
-
-            lastStatusTime = time.time()
-
-         cmdStn.update()
-
-         currentTime = time.time()
-
-         throttlesToDelete = [ ]
-
-         for (key,throttle) in throttles.items():
-            updateTime = throttle.getLastUpdateTime()
-            if (updateTime + (1 * 60)) < currentTime:
-               print("Throttle address 0x%02X has timed out, removing" % key)
-               throttles[key].disconnect(cmdStn)
-               throttlesToDelete.append(key)
-               print("Throttle disconnected")
-
-         for key in throttlesToDelete:
-             del throttles[key]
-
-         if pkt == None:
-            continue
-
-         if pkt.src == baseAddress:
-            print("Conflicting ProtoThrottle base station detected!!!\nTurning Error LED on\n")
-            errorLightOn = True
-            lastErrorTime = getMillis()
-            mrbee.setXbeeLED('D6', errorLightOn)
-
-
-         # Bypass anything that doesn't look like a throttle packet
-         if pkt.cmd != 0x53 or len(pkt.data) != 9 or baseAddress != pkt.dest:
-            continue
-
-         # Create a MRBusThrottle object for every new Protothrottle that shows up
-         if pkt.src not in throttles:
-            throttles[pkt.src] = MRBusThrottle.MRBusThrottle(pkt.src)
-#         print("PT-BRIDGE: Processing packet from throttle %02X" % (pkt.src))
-         throttles[pkt.src].update(cmdStn, pkt)
-#         print("PT-BRIDGE: Done processing packet from throttle %02X" % (pkt.src))
-         
-         lastPktTime = getMillis()
-         if False == pktLightOn:
-            print("Turning ProtoThrottle packet received LED on")
-            pktLightOn = True
-            mrbee.setXbeeLED('D7', pktLightOn)
+         for timerName in timers.expired(time.time()):
+            timerExpired(timerName)
 
       except (KeyboardInterrupt):
+         selector.close()
+
          try:
             cmdStn.disconnect()
          except:
@@ -551,6 +697,8 @@ while 1:
          traceback.print_exception(*exc_info)
          del exc_info         
 
+         selector.close()
+
          try:
             cmdStn.disconnect()
             cmdStn = None
@@ -30,8 +30,37 @@
 # *************************************************************************
 
 import socket
+import select
 import re
 import time
+import concurrent.futures
+import collections
+
+class ESUReply:
+   """The outcome of one command sent to the command station - the code and message from its
+      <END> line, the lines between <REPLY> and <END>, and those lines parsed if a regex was given."""
+   def __init__(self, cmdStr, errCode, errStr, lines, results):
+      self.cmdStr = cmdStr
+      self.errCode = errCode
+      self.errStr = errStr
+      self.lines = lines
+      self.results = results
+
+   def ok(self):
+      return self.errCode == 0
+
+class ESUTimeout(Exception):
+   """Set on a command's reply future when the command station hasn't answered it within its deadline."""
+   pass
+
+class ESUEvent:
+   """One unsolicited <EVENT objID> block from the command station - the object it's about, the lines
+      describing what changed, and the code and message from its <END> line."""
+   def __init__(self, objID, errCode, errStr, lines):
+      self.objID = objID
+      self.errCode = errCode
+      self.errStr = errStr
+      self.lines = lines
 
 class ESUConnection:
    """An interface to talk to an ESU CabControl command station via the network in order to
@@ -41,16 +70,56 @@ class ESUConnection:
    # Define a few constants - the ESU port is always 15471
    ESU_PORT = 15471
    ESU_RCV_SZ = 8192
+   # How long, in seconds, each kind of command gets to be answered before it's failed with ESUTimeout.
+   # A busy ECoS can take several hundred milliseconds over a set(), and failing one that did go through
+   # throws away the state mirror for that locomotive, while reading the whole locomotive list legitimately
+   # takes a while.
+   ESU_CMD_TIMEOUTS = { 'set':1.0, 'get':1.0, 'request':1.0, 'release':1.0, 'create':1.0, 'queryObjects':2.0 }
+   ESU_REPLY_TIMEOUT = 1.0
+   # Most func[] arguments sent in one set() - keeps each command line short enough for the command station to take
+   ESU_MAX_SET_FUNCS = 8
+
+   # MRBusThrottle sends all of a packet's function changes in one locomotiveFunctionDictSet() call if this is set
+   supportsFunctionDictSet = True
 
    # Some pre-compiled regexs used in response parsing
-   REglobalList = re.compile("(?P<objID>\d+)\s+addr\[(?P<locAddr>\d+)\].*")
-   RElocAdd = re.compile("10\s+id\[(?P<objID>\d+)\].*")
-   REend = re.compile("<END (?P<errCd>\d+) \((?P<errStr>[a-zA-Z0-9 ]+)\)>.*") 
-   #REend = re.compile("<.*") #END.*")# (?P<errCd>\d+) .*") #\((?P<errStr>[a-zA-Z0-9 ]+)\)>.*") 
+   REglobalList = re.compile(r"(?P<objID>\d+)\s+addr\[(?P<locAddr>\d+)\].*")
+   RElocAdd = re.compile(r"10\s+id\[(?P<objID>\d+)\].*")
+   REreply = re.compile(r"<REPLY (?P<cmdStr>.*)>$")
+   REevent = re.compile(r"<EVENT (?P<objID>\d+)>")
+   REobjLine = re.compile(r"(?P<objID>\d+)\s+(?P<options>.*)")
+   REoption = re.compile(r"(?P<name>\w+)\[(?P<args>[^\]]*)\]")
+   REspeedSet = re.compile(rb"set\((?P<objID>\d+), speed\[")
+   REend = re.compile(r"<END (?P<errCd>\d+)\s*(\((?P<errStr>.*)\))?\s*>")
    
-   def __init__(self):
-      """Constructor for the object.  Any internal initialization should occur here."""
-      pass
+   def __init__(self, pipelined=True):
+      """Constructor for the object.  Any internal initialization should occur here.
+         With pipelined set, speed, function and stop commands are sent without waiting for their
+         replies, which are matched up later as they arrive."""
+      self.pipelined = pipelined
+      self.pending = [ ]
+      # Commands not completely written yet, oldest first, with how much of the first has gone out, and the
+      # urgent commands from locomotiveEmergencyStop() waiting to go in front of them as (objID, command)
+      self.txQueue = collections.deque()
+      self.txSent = 0
+      self.txUrgent = collections.deque()
+      self.rxBuffer = bytearray()
+      self.rxReply = None
+      self.rxEvent = None
+      self.rxDiscard = False
+      self.locoObjIDs = None
+      self.locoListOwnChanges = 0
+      # Lookups still waiting on the command station - the list being read, creates by address, and
+      # how many replies each locomotive being subscribed is still waiting on
+      self.locoTableLoading = None
+      self.locoAdding = { }
+      self.locoSubscribing = { }
+      self.locoState = { }
+      self.speedSlots = { }
+      self.speedInFlight = { }
+      self.eventSubscribers = { }
+      self.eventSubscribe(10, self.esuLocoListEvent)
+      self.eventSubscribe(None, self.esuStateEvent)
      
    def connect(self, ip, port = None):
       """Connect this object to an ESU CabControl command station on the IP address specified."""
@@ -61,11 +130,39 @@ class ESUConnection:
          self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
          self.conn.settimeout(0.5)
          self.conn.connect((ip, port))
-         self.conn.settimeout(0.01)
          print("ESU Command station connection succeeded")
-         self.conn.settimeout(5)
+         # Nothing waits on the socket itself - every command has its own deadline instead
+         self.conn.setblocking(False)
       except:
          print("ESU Command station connection failed")
+         return
+
+      # Anything cached or half received from a previous connection may be stale
+      self.txQueue.clear()
+      self.txSent = 0
+      self.txUrgent.clear()
+      del self.rxBuffer[:]
+      self.rxReply = None
+      self.rxEvent = None
+      self.rxDiscard = False
+      self.locoObjIDs = None
+      self.locoListOwnChanges = 0
+      # Lookups still waiting on the command station - the list being read, creates by address, and
+      # how many replies each locomotive being subscribed is still waiting on
+      self.locoTableLoading = None
+      self.locoAdding = { }
+      self.locoSubscribing = { }
+      self.locoState = { }
+      self.speedSlots = { }
+      self.speedInFlight = { }
+      try:
+         # Ask to hear about changes to the locomotive list so the cache can be thrown away when it changes
+         self.esuTXRX("request(10, view)")
+         self.locomotiveTableLoad()
+      except Exception as e:
+         print("ESU Unable to load locomotive table, will retry on first use")
+         print(e)
+         self.locoObjIDs = None
       
    def disconnect(self):
       """Disconnect from the CabControl command station in a clean way."""
@@ -76,103 +173,456 @@ class ESUConnection:
       except:
          print("ESU Command station connection closed with exception, ignoring")
       self.conn = None
+      self.pending = [ ]
+      self.txQueue.clear()
+      self.txSent = 0
+      self.txUrgent.clear()
+      del self.rxBuffer[:]
+      self.rxReply = None
+      self.rxEvent = None
+      self.rxDiscard = False
+      self.locoObjIDs = None
+      self.locoListOwnChanges = 0
+      # Lookups still waiting on the command station - the list being read, creates by address, and
+      # how many replies each locomotive being subscribed is still waiting on
+      self.locoTableLoading = None
+      self.locoAdding = { }
+      self.locoSubscribing = { }
+      self.locoState = { }
+      self.speedSlots = { }
+      self.speedInFlight = { }
       
+   def esuSend(self, cmdStr, parseRE=None, resultKey='', timeout=None, urgentObjID=None):
+      """Internal function to send a command without waiting for the reply.  Returns a
+         concurrent.futures.Future that is given an ESUReply once the reply has been received
+         by esuReceive(), which update() and esuTXRX() both call.  If no reply arrives within
+         timeout seconds (by default the ESU_CMD_TIMEOUTS entry for the command) the future
+         is failed with ESUTimeout instead.  A command for locomotive urgentObjID goes ahead of
+         everything still waiting to be written - see esuUrgentMove()."""
+      if timeout is None:
+         timeout = self.ESU_CMD_TIMEOUTS.get(cmdStr.split('(')[0].strip(), self.ESU_REPLY_TIMEOUT)
+      reply = concurrent.futures.Future()
+      reply.add_done_callback(self.esuReplyCheck)
+      self.pending.append((cmdStr, parseRE, resultKey, reply, time.time() + timeout))
+      if urgentObjID is None:
+         self.txQueue.append(str.encode(cmdStr))
+      else:
+         self.txUrgent.append((urgentObjID, str.encode(cmdStr)))
+      self.esuTransmit()
+      print(("ESU: Sent command [%s]" % (cmdStr)))
+      return reply
+
+   def esuTransmit(self):
+      """Internal function that writes as many of the waiting commands as the socket will take without blocking.
+         Anything left is sent by a later call."""
+      txQueue = self.txQueue
+      if len(self.txUrgent):
+         self.esuUrgentMove()
+      while len(txQueue):
+         data = b"".join(txQueue)
+         try:
+            sent = self.conn.send(data[self.txSent:])
+         except (BlockingIOError, InterruptedError):
+            return
+         sent += self.txSent
+         while len(txQueue) and sent >= len(txQueue[0]):
+            sent -= len(txQueue.popleft())
+         self.txSent = sent
+
+   def esuUrgentMove(self):
+      """Internal function that moves the urgent commands to the front of the transmit queue, behind only a command
+         that has partly gone out already.  A speed still waiting for a locomotive being stopped is older than the
+         stop, so it's dropped, and its reply is failed so the next speed isn't held up waiting for it."""
+      txQueue = self.txQueue
+      head = [ ]
+      if self.txSent:
+         head.append(txQueue.popleft())
+      stopped = set(objID for (objID, cmd) in self.txUrgent)
+      waiting = [ ]
+      for cmd in txQueue:
+         m = self.REspeedSet.match(cmd)
+         if m is not None and int(m.group('objID')) in stopped:
+            self.esuDrop(cmd.decode())
+         else:
+            waiting.append(cmd)
+      txQueue.clear()
+      txQueue.extend(head + [ cmd for (objID, cmd) in self.txUrgent ] + waiting)
+      self.txUrgent.clear()
+
+   def esuDrop(self, cmdStr):
+      """Internal function that fails the reply to a command that was never sent."""
+      for pend in self.pending:
+         if pend[0] == cmdStr:
+            self.pending.remove(pend)
+            pend[3].set_exception(ESUTimeout("[%s] dropped for an emergency stop" % (cmdStr)))
+            return
+
+   def esuReplyCheck(self, reply):
+      if reply.exception() is not None:
+         print("ESU: %s" % (reply.exception()))
+      elif not reply.result().ok():
+         r = reply.result()
+         print("ESU: Command [%s] failed - error %d (%s)" % (r.cmdStr, r.errCode, r.errStr))
+
+   def esuWait(self, reply):
+      """Internal function that holds until a command sent with esuSend() has its reply, handling replies
+         to any other pipelined commands that arrive first.  Returns the ESUReply, or raises ESUTimeout
+         if the command's deadline passes first."""
+      # Need to hold here until we get a full response or we timeout
+      while not reply.done():
+         self.esuReceive(self.esuTimeout(time.time()))
+         self.esuExpire(time.time())
+      return reply.result()
+
+   def esuTimeout(self, now):
+      """Internal function returning the seconds until the earliest pending command's deadline (0 if one has
+         already passed), or None if no command is waiting on a reply."""
+      deadlines = [ pend[4] for pend in self.pending ]
+      if self.rxReply is not None:
+         deadlines.append(self.rxReply[0][4])
+      if len(deadlines) == 0:
+         return None
+      return max(0, min(deadlines) - now)
+
+   def esuExpire(self, now):
+      """Internal function that fails every pending command whose deadline has passed with ESUTimeout."""
+      expired = [ pend for pend in self.pending if pend[4] <= now ]
+      if self.rxReply is not None and self.rxReply[0][4] <= now:
+         # Its reply was partly received - throw the rest of it away as it arrives, so its <END> can't
+         # be taken for the end of the next reply
+         expired.append(self.rxReply[0])
+         self.rxReply = None
+         self.rxDiscard = True
+      for pend in expired:
+         if pend in self.pending:
+            self.pending.remove(pend)
+         (cmdStr, parseRE, resultKey, reply, deadline) = pend
+         reply.set_exception(ESUTimeout("No reply to [%s] in time" % (cmdStr)))
+
    def esuTXRX(self, cmdStr, parseRE=None, resultKey=''):
       """Internal shared function for transacting with the command station."""
-      # Flush connection buffer
+      reply = self.esuSend(cmdStr, parseRE, resultKey)
+      return self.esuWait(reply).results
 
+   def esuSet(self, objID, cmdStr):
+      """Internal function for set() commands.  Doesn't wait for the reply when pipelined, and if the command
+         station refuses the command, forgets the mirrored state of objID since it's no longer known."""
+      reply = self.esuSend(cmdStr)
+      reply.add_done_callback(lambda r: self.esuSetCheck(objID, r))
+      if not self.pipelined:
+         self.esuWait(reply)
+      return reply
 
-      self.conn.send(str.encode(cmdStr))
-      print(("ESU: Sent command [%s]" % (cmdStr)))
+   def esuSetCheck(self, objID, reply):
+      if reply.exception() is None and reply.result().ok():
+         return
+      if objID in self.locoState:
+         self.locoState[objID] = self.locoStateUnknown()
+
+   def esuReceive(self, timeout):
+      """Internal function that reads whatever the command station has sent and completes the pending
+         command for every full reply.  Waits up to timeout seconds for data (forever if None), finishing
+         any unsent commands meanwhile.  Lines can be split across reads, so anything after the last
+         newline is kept for next time."""
+      if len(self.txQueue):
+         (readable, writable, errored) = select.select([ self.conn ], [ self.conn ], [], timeout)
+         if len(writable):
+            self.esuTransmit()
+      else:
+         (readable, writable, errored) = select.select([ self.conn ], [], [], timeout)
+      if len(readable) == 0:
+         return False
+
+      try:
+         resp = self.conn.recv(self.ESU_RCV_SZ)
+      except (BlockingIOError, InterruptedError):
+         return False
+      if len(resp) == 0:
+         raise Exception("ESU command station closed the connection")
+
+      rxBuffer = self.rxBuffer
+      start = len(rxBuffer)
+      rxBuffer += resp
+      # Only the new data can hold a newline we haven't seen
+      end = rxBuffer.find(b'\n', start)
+      if end < 0:
+         return True
 
-      responseComplete = False
-      responseStartFound = False
-      commandResponse = []
+      start = 0
+      while end >= 0:
+         thisLine = rxBuffer[start:end].decode(errors='replace').strip()
+         if len(thisLine):
+            self.esuLine(thisLine)
+         start = end + 1
+         end = rxBuffer.find(b'\n', start)
+      del rxBuffer[:start]
+      return True
+
+   def esuLine(self, thisLine):
+      """Internal function that handles one line received from the command station."""
+      if self.rxDiscard:
+         # Inside a reply nobody is waiting for any more
+         if self.REend.match(thisLine) is not None:
+            self.rxDiscard = False
+         return
+
+      if self.rxEvent is not None:
+         # Inside an event block - every line up to <END> describes a change to an object
+         (objID, eventLines) = self.rxEvent
+         m = self.REend.match(thisLine)
+         if m is None:
+            eventLines.append(thisLine)
+            return
+         self.rxEvent = None
+         self.esuEventDispatch(ESUEvent(objID, int(m.group('errCd')), m.group('errStr') or '', eventLines))
+         return
+
+      if self.rxReply is None:
+         m = self.REreply.match(thisLine)
+         if m is None:
+            m = self.REevent.match(thisLine)
+            if m is None:
+               print(("ESU: No start tag - throwing away line [%s]" % (thisLine)))
+               return
+            self.rxEvent = (int(m.group('objID')), [ ])
+            return
+
+         # Replies carry the command they answer, so match on that rather than assuming order.
+         # A command that timed out is no longer pending, so a late reply to it ends up thrown away.
+         for i in range(0, len(self.pending)):
+            if self.pending[i][0] == m.group('cmdStr'):
+               print(("ESU: Found start line - [%s]" % (thisLine)))
+               self.rxReply = (self.pending.pop(i), [ ])
+               return
+         print(("ESU: No command waiting for reply - throwing away reply [%s]" % (thisLine)))
+         self.rxDiscard = True
+         return
+
+      ((cmdStr, parseRE, resultKey, reply, deadline), commandResponse) = self.rxReply
+      m = self.REend.match(thisLine)
+      if m is None:
+         print(("Adding line to response [%s]" % (thisLine)))
+         commandResponse.append(thisLine)
+         return
+
+      print(("Found end line [%s]" % (thisLine)))
+      self.rxReply = None
       results = { }
-            
-      # Need to hold here until we get a full response or we timeout
-      while not responseComplete:
-         resp = self.conn.recv(self.ESU_RCV_SZ).decode()
-         # Find the response
-         lines = resp.splitlines()
-         numDataElements = len(lines)
-         for i in range(0, numDataElements):
-            thisLine = lines[i]
-            if not responseStartFound:
-               if thisLine == ("<REPLY %s>" % (cmdStr)):
-                  print(("ESU: Found start line - [%s]" % (thisLine)))
-                  responseStartFound = True
-                  commandResponse.append(thisLine)
+
+      if parseRE is not None:
+         print("ESU: Parsing results")
+
+         for idx in range(0, len(commandResponse)):
+            try:
+               parsed = parseRE.match(commandResponse[idx])
+
+               if resultKey == "":
+                  results[len(results)] = parsed.groupdict()
                else:
-                  print(("ESU: No start tag - throwing away line [%s]" % (thisLine)))
-            else:
-               print(("Adding line to response [%s]" % (thisLine)))
-               commandResponse.append(thisLine)
-               if thisLine == "<END 0 (OK)>":
-                  print(("Found end line [%s]" % (thisLine)))
-                  responseComplete = True
-               
+                  results[parsed.group(resultKey)] = parsed.groupdict()
+            except:
+               print(("ESU esuRXTX Line %d does not match regex\n  Line %d: [%s]" % (idx, idx, commandResponse[idx])))
+
+      reply.set_result(ESUReply(cmdStr, int(m.group('errCd')), m.group('errStr') or '', commandResponse, results))
+
+   def eventSubscribe(self, objID, callback):
+      """Arranges for callback to be called with an ESUEvent for every event the command station sends
+         about objID, or for every event at all if objID is None.  The command station only sends events
+         for objects it has been sent a request(objID, view) for."""
+      self.eventSubscribers.setdefault(objID, [ ]).append(callback)
 
-      if not responseComplete:
-         print("ESU: Response to command failed")
-         return results
+   def eventUnsubscribe(self, objID, callback):
+      if callback in self.eventSubscribers.get(objID, [ ]):
+         self.eventSubscribers[objID].remove(callback)
 
-      if parseRE is None:
-         return results
+   def esuEventDispatch(self, event):
+      """Internal function that hands a received event to everything subscribed to it."""
+      for callback in self.eventSubscribers.get(event.objID, [ ]) + self.eventSubscribers.get(None, [ ]):
+         try:
+            callback(event)
+         except Exception as e:
+            print("ESU: Event handler for object %d failed" % (event.objID))
+            print(e)
+
+   def esuLocoListEvent(self, event):
+      if self.locoListOwnChanges > 0:
+         self.locoListOwnChanges -= 1
+         print("ESU: Locomotive list changed by our own create(), keeping cached object IDs")
+         return
+      # Locomotives have been added, removed or changed elsewhere
+      print("ESU: Locomotive list changed, dropping cached object IDs")
+      self.locoObjIDs = None
 
-      print("ESU: Parsing results")
+   def esuStateEvent(self, event):
+      for thisLine in event.lines:
+         self.esuStateLine(thisLine)
 
-      for idx in range(1, len(commandResponse)-1):
+   def esuStateLine(self, thisLine):
+      """Internal function that copies any speed, direction or function values in a line like
+         "1000 speed[12] dir[0]" or "1000 func[3,1]" into the state mirror for that object."""
+      m = self.REobjLine.match(thisLine)
+      if m is None:
+         return
+      state = self.locoState.get(int(m.group('objID')))
+      if state is None:
+         return
+
+      for (name, args) in self.REoption.findall(m.group('options')):
          try:
-            parsed = parseRE.match(commandResponse[idx])
+            if name == 'speed':
+               state['speed'] = int(args)
+            elif name == 'dir':
+               state['dir'] = int(args)
+            elif name == 'func':
+               (funcNum, funcVal) = args.split(',')
+               funcNum = int(funcNum)
+               if funcNum >= 0 and funcNum < 29:
+                  state['funcs'][funcNum] = int(funcVal)
+         except ValueError:
+            print(("ESU: Unable to parse [%s] in line [%s]" % (name, thisLine)))
+
+   def esuStateReply(self, reply):
+      if reply.exception() is None:
+         for thisLine in reply.result().lines:
+            self.esuStateLine(thisLine)
 
-            if resultKey == "":
-               results[len(results)] = parsed.groupdict()
-            else:
-               results[parsed.group(resultKey)] = parsed.groupdict()
-         except:
-            print(("ESU esuRXTX Line %d does not match regex\n  Line %d: [%s]" % (idx, idx, commandResponse[idx])))
+   def locoStateUnknown(self):
+      """Internal function returning a state mirror entry with nothing known yet."""
+      return { 'speed':None, 'dir':None, 'funcs':[None] * 29 }
 
-      return results
+   def locomotiveSubscribe(self, objID):
+      """Internal function that asks the command station for events on a locomotive object and reads its current
+         speed, direction and functions into the state mirror.  Does nothing if we're already watching it."""
+      if objID in self.locoState:
+         return
+      self.locoState[objID] = self.locoStateUnknown()
+
+      replies = [ self.esuSend("request(%d, view)" % (objID)) ]
+      queries = [ "get(%d, speed, dir)" % (objID) ]
+      for i in range(0, 29, self.ESU_MAX_SET_FUNCS):
+         funcStr = "".join([", func[%d]" % (funcNum) for funcNum in range(i, min(29, i + self.ESU_MAX_SET_FUNCS))])
+         queries.append("get(%d%s)" % (objID, funcStr))
+      for cmdStr in queries:
+         reply = self.esuSend(cmdStr)
+         reply.add_done_callback(self.esuStateReply)
+         replies.append(reply)
+
+      # All of these are in flight together, so this costs about one round trip, and none of it is waited on -
+      # the locomotive is ready once esuSubscribeReply() has counted off every reply
+      self.locoSubscribing[objID] = len(replies)
+      for reply in replies:
+         reply.add_done_callback(lambda r: self.esuSubscribeReply(objID, r))
+
+   def esuSubscribeReply(self, objID, reply):
+      """Internal function that counts off the replies to locomotiveSubscribe()'s commands.  Anything that didn't
+         come back in time just stays unknown in the mirror, which only means nothing gets suppressed."""
+      if objID not in self.locoSubscribing:
+         return
+      self.locoSubscribing[objID] -= 1
+      if self.locoSubscribing[objID] == 0:
+         del self.locoSubscribing[objID]
+         print("ESU: Locomotive object %d is ready" % (objID))
 
    def esuLocomotiveAdd(self, locoNum, locoName=""):
-      """Internal function for adding a locomotive to the command station's object table."""
-      print("ESU: Adding locomotive address [%d]" % (int(locoNum)))
-      cmdStr = "create(10, addr[%d], append)" % ( int(locoNum))
-      result = self.esuTXRX(cmdStr, self.RElocAdd)
-      print("ESU: Locomotive added at objID [%d]" % (int(result[0]['objID'])))
-      return int(result[0]['objID'])
+      """Internal function that asks the command station to add a locomotive to its object table.  The new objID
+         goes into the address to objID cache once esuLocomotiveAddReply() has it.  Does nothing if that locomotive
+         is already being added."""
+      locAddr = int(locoNum)
+      if locAddr in self.locoAdding:
+         return
+      print("ESU: Adding locomotive address [%d]" % (locAddr))
+      cmdStr = "create(10, addr[%d], append)" % (locAddr)
+      # The command station announces our own create() as a change to the locomotive list, and that
+      # change is one the cache is about to have anyway - see esuLocoListEvent()
+      self.locoListOwnChanges += 1
+      reply = self.esuSend(cmdStr, self.RElocAdd)
+      reply.add_done_callback(lambda r: self.esuLocomotiveAddReply(locAddr, r))
+      self.locoAdding[locAddr] = reply
+
+   def esuLocomotiveAddReply(self, locAddr, reply):
+      if self.locoAdding.get(locAddr) is not reply:
+         return
+      del self.locoAdding[locAddr]
+      if reply.exception() is not None:
+         # It may still have gone through, so reread the list rather than create a second copy next time
+         self.locoListOwnChanges = max(0, self.locoListOwnChanges - 1)
+         self.locoObjIDs = None
+         return
+      result = reply.result()
+      if not result.ok() or len(result.results) == 0:
+         self.locoListOwnChanges = max(0, self.locoListOwnChanges - 1)
+         return
+      objID = int(result.results[0]['objID'])
+      print("ESU: Locomotive %d added at objID [%d]" % (locAddr, objID))
+      if self.locoObjIDs is not None:
+         self.locoObjIDs[locAddr] = objID
+
+   def locomotiveTableLoad(self):
+      """Internal function that asks for the command station's whole locomotive list, which esuLocoTableReply() puts
+         into the address to objID cache once it arrives.  Does nothing if the list has already been asked for."""
+      if self.locoTableLoading is not None:
+         return
+      reply = self.esuSend("queryObjects(10,addr)", self.REglobalList, 'locAddr')
+      reply.add_done_callback(self.esuLocoTableReply)
+      self.locoTableLoading = reply
+
+   def esuLocoTableReply(self, reply):
+      if self.locoTableLoading is not reply:
+         return
+      self.locoTableLoading = None
+      # Anything that went wrong has already been printed, and the next locomotiveObjectGet() asks again
+      if reply.exception() is not None or not reply.result().ok():
+         return
+      locoList = reply.result().results
+      self.locoObjIDs = dict((int(locAddr), int(loco['objID'])) for (locAddr, loco) in locoList.items())
+      print("ESU: Loaded %d locomotives from the command station" % (len(self.locoObjIDs)))
 
    def locomotiveObjectGet(self, locoNum, cabID, isLongAddress):
-      """Acquires and returns a handle that will be used to control a locomotive address."""
+      """Acquires and returns a handle that will be used to control a locomotive address.  Nothing here waits on the
+         command station - looking the address up, adding it and reading its state all finish from their replies -
+         so this returns None until the locomotive is ready, and should just be asked again later."""
       print(("ESU: locomotiveObjectGet(%d, 0x%02X)" % (locoNum, cabID)))
       
-      cmdStr = "queryObjects(10,addr)"
-      locoList = self.esuTXRX(cmdStr, self.REglobalList, 'locAddr')
-      
-      locAddr = "%d" % (int(locoNum))
-      
-      if locAddr in list(locoList.keys()):
-         objID = int(locoList[locAddr]['objID'])
-         print("ESU: Found locomotive %s at object %d" % (locAddr, objID))
-         return objID
-      else:
+      locAddr = int(locoNum)
+
+      # The list is only reread if it's changed since we last looked
+      if self.locoObjIDs is None:
+         self.locomotiveTableLoad()
+         return None
+
+      objID = self.locoObjIDs.get(locAddr)
+      if objID is None:
          print("ESU: Need to add this locomotive")
-         objID = self.esuLocomotiveAdd(locoNum)
-         print("ESU: Added locomotive %s at object %d" % (locAddr, objID))
-         return objID
+         self.esuLocomotiveAdd(locAddr)
+         return None
+
+      self.locomotiveSubscribe(objID)
+      if objID in self.locoSubscribing:
+         return None
+      print("ESU: Found locomotive %d at object %d" % (locAddr, objID))
+      return objID
          
    def locomotiveEmergencyStop(self, objID):
       """Issues an emergency stop command to a locomotive handle that has been previously acquired with locomotiveObjectGet()."""
       objID = int(objID)
       cmdStr = "set (%d, stop)" % (objID)
-      self.esuTXRX(cmdStr)
+      # Never suppressed or queued - the locomotive has to stop no matter what we think it's doing,
+      # and any speed still waiting to go out is older than the stop
+      self.speedSlots.pop(objID, None)
+      if objID in self.locoState:
+         self.locoState[objID]['speed'] = 0
+      # It goes ahead of every command still waiting to be written, and never waits for its reply, even when
+      # not pipelined, so a slow command station can't hold it up
+      reply = self.esuSend(cmdStr, urgentObjID=objID)
+      reply.add_done_callback(lambda r: self.esuSetCheck(objID, r))
+      return reply
       
 
    # For the purposes of this function, direction of 0=forward, 1=reverse
    def locomotiveSpeedSet(self, objID, speed, direction=0):
       """Sets the speed and direction of a locomotive via a handle that has been previously acquired with locomotiveObjectGet().  
-         Speed is 0-127, Direction is 0=forward, 1=reverse."""
+         Speed is 0-127, Direction is 0=forward, 1=reverse.  The setting waits in the locomotive's slot until flush(),
+         and replaces anything already there, so a burst of changes only sends the last one."""
       objID = int(objID)
       speed = int(speed)
       direction = int(direction)
@@ -184,10 +634,24 @@ class ESUConnection:
       if speed >= 127 or speed < 0:
          speed = 0
 
+      if objID in self.speedSlots:
+         (oldSpeed, oldDirection) = self.speedSlots[objID]
+         print("ESU: locomotiveSpeedSet(%d): replacing queued speed %d %s" % (objID, oldSpeed, ["FWD","REV"][oldDirection]))
+      self.speedSlots[objID] = (speed, direction)
+
+   def locomotiveSpeedSend(self, objID, speed, direction):
+      """Internal function that sends a speed and direction from a locomotive's slot, unless the command station already has it."""
+      state = self.locoState.get(objID)
+      if state is not None:
+         if state['speed'] == speed and state['dir'] == direction:
+            print("ESU: locomotiveSpeedSet(%d): already at speed %d %s" % (objID, speed, ["FWD","REV"][direction]))
+            return None
+         state['speed'] = speed
+         state['dir'] = direction
+
       cmdStr = "set(%d, speed[%d], dir[%d])" % (objID, speed, direction)
       print("ESU: locomotiveSpeedSet(%d): set speed %d %s" % (objID, speed, ["FWD","REV"][direction]))
-      self.esuTXRX(cmdStr)
-      print("ESU: locomotiveSpeedSet complete")
+      return self.esuSet(objID, cmdStr)
    
    def locomotiveFunctionSet(self, objID, funcNum, funcVal):
       """Sets or clears a function on a locomotive via a handle that has been previously acquired with locomotiveObjectGet().  
@@ -195,38 +659,79 @@ class ESUConnection:
       objID = int(objID)
       funcNum = int(funcNum)
       funcVal = int(funcVal)
+      state = self.locoState.get(objID)
+      if state is not None:
+         if state['funcs'][funcNum] == funcVal:
+            print("ESU: object %d function %d already %d" % (objID, funcNum, funcVal))
+            return None
+         state['funcs'][funcNum] = funcVal
+
       print("ESU: object %d set function %d to %d" % (int(objID), funcNum, funcVal))
       cmdStr = "set(%d, func[%d,%d])" % (objID, funcNum, funcVal)
-      self.esuTXRX(cmdStr)
-      print("ESU: function set complete")
+      return self.esuSet(objID, cmdStr)
 
    def locomotiveFunctionDictSet(self, objID, funcDict):
-      """Don't use this!  An effort to set multiple functions at a time that doesn't really work yet."""
+      """Sets or clears several functions on a locomotive at once.  funcDict maps funcNum (0-28) to funcVal (0 or 1).
+         The functions go out as set(objID, func[a,b], func[c,d], ...) commands of at most ESU_MAX_SET_FUNCS each."""
       objID = int(objID)
-      funcStr = ""
-      for funcNum in funcDict:
-         funcNum = int(funcNum)
-         funcVal = int(funcDict[funcNum])
-         
-         funcStr = funcStr + ", func[%d,%d]" % (funcNum, funcVal)
-     
-      cmdStr = "set(%d%s])" % (objID, funcStr)
-      self.esuTXRX(cmdStr)
-      
-      print("ESU locomotiveFunctionSet(%d): set func %d to %d" % (int(objID), funcNum, funcVal))
+      funcs = sorted((int(funcNum), int(funcVal)) for (funcNum, funcVal) in funcDict.items())
+      replies = [ ]
+
+      # Leave out anything the command station already has
+      state = self.locoState.get(objID)
+      if state is not None:
+         funcs = [ (funcNum, funcVal) for (funcNum, funcVal) in funcs if state['funcs'][funcNum] != funcVal ]
+         for (funcNum, funcVal) in funcs:
+            state['funcs'][funcNum] = funcVal
+
+      for i in range(0, len(funcs), self.ESU_MAX_SET_FUNCS):
+         funcStr = "".join([", func[%d,%d]" % (funcNum, funcVal) for (funcNum, funcVal) in funcs[i:i+self.ESU_MAX_SET_FUNCS]])
+         cmdStr = "set(%d%s)" % (objID, funcStr)
+         print("ESU: object %d set functions %s" % (objID, funcStr[2:]))
+         replies.append(self.esuSet(objID, cmdStr))
+
+      return replies
 
    def locomotiveDisconnect(self, objID):
       print("ESU locomotiveDisconnect(%d): disconnect" % (int(objID)))
  
    def locomotiveFunctionsGet(self, objID):
-     print("ESU locomotiveFunctionsGet(%d)" % (int(objID)))
-     print(" ...isn't implemented yet\n")
-     return [0] * 29
+      """Returns the function states the command station last reported for a locomotive, as a list of 29 values.
+         These come from the state mirror, so this never waits on the command station."""
+      objID = int(objID)
+      print("ESU locomotiveFunctionsGet(%d)" % (objID))
+      state = self.locoState.get(objID)
+      if state is None:
+         return [0] * 29
+      return [ (funcVal or 0) for funcVal in state['funcs'] ]
+
+   def filenos(self):
+      """Returns the file descriptors the run loop watches for this command station - just the socket."""
+      return [ self.conn.fileno() ]
+
+   def flush(self):
+      """Sends the speed and direction waiting in each locomotive's slot.  Should be called once all of a burst of
+         throttle packets has been handled.  A locomotive whose last speed command hasn't been answered yet keeps
+         its slot until it has, so there's never more than one speed command per locomotive waiting on the
+         command station and whatever goes out next is the newest setting.  Always returns 0 - unlike a WiThrottle
+         server, the ECoS isn't rate limited, so nothing is held back for a later flush()."""
+      for objID in list(self.speedSlots.keys()):
+         inFlight = self.speedInFlight.get(objID)
+         if inFlight is not None and not inFlight.done():
+            continue
+         (speed, direction) = self.speedSlots.pop(objID)
+         self.speedInFlight[objID] = self.locomotiveSpeedSend(objID, speed, direction)
+      return 0
 
    def update(self):
-      """This should be called frequently within the main program loop.  While it doesn't do anything for ESU,
-         other command station interfaces have housekeeping work that needs to be done periodically."""
-      return
+      """This should be called frequently within the main program loop, and whenever the socket is readable.
+         It picks up replies to pipelined commands without blocking, fails any that are overdue with ESUTimeout
+         and sends any speed settings that were waiting on them."""
+      self.esuTransmit()
+      while self.esuReceive(0):
+         pass
+      self.esuExpire(time.time())
+      return self.flush()
 
    
    
@@ -33,22 +33,33 @@ import logging
 import time
 from collections import deque
 import sys
+import mrbusCRC
+import xbee
 
 class packet(object):
-  def __init__(self, dest, src, cmd, data):
+  """A received MRBus packet.  data is kept as bytes - for packets off the radio it is simply a
+     slice of the received frame - and hashing and equality work straight from the raw fields.
+     rxTime is when the read that completed the packet came back from the serial port, or None
+     for a packet that wasn't received; it isn't part of hashing or equality."""
+  __slots__ = ('dest', 'src', 'cmd', 'data', 'rxTime')
+
+  def __init__(self, dest, src, cmd, data, rxTime=None):
     self.dest=dest
     self.src=src
     self.cmd=cmd
-    self.data=data
+    self.data=bytes(data)
+    self.rxTime=rxTime
 
   def __hash__(self):
-    return hash(repr(self))
+    return hash((self.dest, self.src, self.cmd, self.data))
 
   def __eq__(self, other):
-    return repr(self)==repr(other)
+    if not isinstance(other, packet):
+      return NotImplemented
+    return self.dest==other.dest and self.src==other.src and self.cmd==other.cmd and self.data==other.data
 
   def __repr__(self):
-    return "mrbus.packet(0x%02x, 0x%02x, 0x%02x, %s)"%(self.dest, self.src, self.cmd, repr(self.data))
+    return "mrbus.packet(0x%02x, 0x%02x, 0x%02x, %s)"%(self.dest, self.src, self.cmd, repr(list(self.data)))
 
   def __str__(self):
     c='(0x%02X'%self.cmd
@@ -58,6 +69,14 @@ class packet(object):
       c+="    )"
     return "packet(0x%02X->0x%02X) %s %2d:%s"%(self.src, self.dest, c, len(self.data), ["0x%02X"%d for d in self.data])
 
+def popPackets(pkts, max_n=None):
+  """Removes and returns up to max_n packets (all of them if max_n is None) from the front of a deque."""
+  if max_n is None or max_n >= len(pkts):
+    burst = list(pkts)
+    pkts.clear()
+    return burst
+  return [pkts.popleft() for i in range(max_n)]
+
 class node(object):
   def __init__(self, mrb, addr):
     def handler(p):
@@ -105,6 +124,7 @@ class mrbusSimple(object):
 
     self.serial = port
     self.rxBuffer = bytearray()
+    self.rxPkts = deque()
     time.sleep(.1)
     while port.inWaiting():
       port.read(port.inWaiting())
@@ -144,42 +164,56 @@ class mrbusSimple(object):
 #    return self.linebuf.leftpop()
 
 
-# This is ugly, but now works in Python3
-# Probably needs to be revisited and fixed up
-  def getpkt(self):
+  def rxPoll(self):
+    """Reads everything the serial port has waiting in one go and queues a packet for every
+       complete line.  If nothing is waiting, a single byte read honours the port timeout."""
+    waiting = self.serial.in_waiting
+    if waiting == 0:
+      incoming = self.serial.read(1)
+    else:
+      incoming = self.serial.read(waiting)
+    if incoming is None or len(incoming) == 0:
+      return
+    rxTime = time.time()
 
-    while True:
-      incoming = self.serial.read()
-      if incoming is None or len(incoming) == 0:
-        break
-       
-      incomingBytes = bytearray(incoming).strip(b'\r')
-      self.rxBuffer = self.rxBuffer + incomingBytes
-       
-    if b'\n' in self.rxBuffer:
+    self.rxBuffer += incoming.replace(b'\r', b'')
+
+    while b'\n' in self.rxBuffer:
       # We've got complete lines, do something with them
       eolIdx = self.rxBuffer.index(b'\n')
       cmdStr = str(self.rxBuffer[0:eolIdx].decode('utf-8')).strip()
-      self.rxBuffer = self.rxBuffer[eolIdx+1:]
+      del self.rxBuffer[:eolIdx+1]
       #print("Found command [%s]" % cmdStr)
 
       if cmdStr == "Ok":
-        return None
+        continue
       
       if len(cmdStr)<2 or cmdStr[0:2] != 'P:':
         self.logger.error('E3<<<'+cmdStr)
-        return None
+        continue
 
       d=[int(v,16) for v in cmdStr[2:].split()]
       if len(d)<6 or len(d)!=d[2]:
         self.logger.error('E4<<<'+cmdStr)
-        return None
+        continue
       
-      return packet(d[0], d[1], d[5], d[6:])
+      self.rxPkts.append(packet(d[0], d[1], d[5], d[6:], rxTime))
 
-    return None
+  def getpkt(self):
+    if len(self.rxPkts) == 0:
+      self.rxPoll()
+    if len(self.rxPkts) == 0:
+      return None
+    return self.rxPkts.popleft()
 
-  def sendpkt(self, dest, data, src=None):
+  def getpkts(self, max_n=None):
+    """Returns a list of every packet received so far, oldest first, up to max_n of them.
+       Anything beyond max_n is kept for the next call."""
+    self.rxPoll()
+    return popPackets(self.rxPkts, max_n)
+
+  def encodepkt(self, dest, data, src=None):
+    """Returns the MRB-CI2 command that transmits a packet, ready for sendframe()."""
     if src == None:
       src = self.addr
     s = ":%02X->%02X"%(src, dest)
@@ -188,16 +222,26 @@ class mrbusSimple(object):
         d=ord(d)
       s+=" %02X"%(d&0xff)
     s+=";\r"
-    self.logger.debug('>>>MRBUS ' +s)
-    self.serial.write(s)
+    return s.encode()
+
+  def sendframe(self, frame):
+    """Writes a command previously built by encodepkt()."""
+    self.logger.debug('>>>MRBUS ' + frame.decode())
+    self.serial.write(frame)
+
+  def sendpkt(self, dest, data, src=None):
+    self.sendframe(self.encodepkt(dest, data, src))
 
 
 class mrbeeSimple(object):
+  RX_CHUNK_SZ = 1024
+  LED_PINS = {'D6':2, 'D7':3, 'D8':1, 'D9':0}
+
   def __init__(self, port, addr, logger=None, extra=False):
 
-    self.rxBuffer = []
-    self.rxExcapeNext = 0
-    self.rxProcessing = 0
+    self.rxChunk = bytearray(self.RX_CHUNK_SZ)
+    self.rxView = memoryview(self.rxChunk)
+    self.rxPkts = deque()
     self.leds = { 'D6':False, 'D7':False, 'D8':False, 'D9':False }
 
     if type(port)==str:
@@ -218,6 +262,15 @@ class mrbeeSimple(object):
       self.logger = logging.getLogger('mrbus')
 
     self.logger.info("Instantiated mrbeeSimple from %s" % port.name)
+    self.rxParser = xbee.XBeeFrameParser(self.logger)
+    self.txEncoder = xbee.XBeeFrameEncoder()
+    self.txPkt = bytearray()
+
+    # The LED frames never change, so build all eight once
+    self.ledFrames = { }
+    for ledRefdes in self.LED_PINS:
+      for ledState in (True, False):
+        self.ledFrames[(ledRefdes, ledState)] = self.encodeLED(ledRefdes, ledState)
 
     self.addr=addr
    
@@ -237,77 +290,58 @@ class mrbeeSimple(object):
        pass
     self.serial.close()
 
-  def getpkt(self):
-
-    while True:
-       incomingStr = self.serial.read()
-       if incomingStr is None or len(incomingStr) == 0:
+  def rxPoll(self):
+    """Drains everything the serial port has waiting in one read and queues every complete
+       MRBus packet found.  If nothing is waiting, a single byte read honours the port timeout."""
+    waiting = self.serial.in_waiting
+    if waiting == 0:
+       incoming = self.serial.read(1)
+       if incoming is None or len(incoming) == 0:
+          return
+       self.rxFrames(self.rxParser.feed(incoming), time.time())
+       waiting = self.serial.in_waiting
+
+    while waiting > 0:
+       rxView = self.rxView[:min(waiting, len(self.rxChunk))]
+       n = self.serial.readinto(rxView)
+       if n is None or n == 0:
           break
-       
-       #incomingByte = ord(incomingStr[0])
-       incomingByte = 0xFF & incomingStr[0]
-       
-       #self.logger.info("mrbee got byte [0x%02x]" % (incomingByte))
-
-       if 0x7E == incomingByte:
-          #self.logger.debug("mrbee starting new packet")
-          self.rxBuffer = [ incomingByte ]
-          self.rxExcapeNext = 0
-          self.rxProcessing = 1 
-          self.rxExpectedPktLen = 255
-          continue
-          
-       elif 0x7D == incomingByte:
-#          self.logger.debug("mrbee setting escape")
-          self.rxExcapeNext = 1
+       self.rxFrames(self.rxParser.feed(rxView[:n]), time.time())
+       waiting = self.serial.in_waiting
+
+  def rxFrames(self, frames, rxTime):
+    for frame in frames:
+       if len(frame) == 0:
           continue
-       
+       if 0x80 == frame[0]:
+          # 64 bit addressing
+          pktDataOffset = 11
+       elif 0x81 == frame[0]:
+          # 16 bit addressing
+          pktDataOffset = 5
        else:
-          if self.rxProcessing == 0:
-#             self.log(0, "mrbee got byte %02X outside processing, ignoring\n" % incomingByte)
-             continue
-       
-          if self.rxExcapeNext != 0:
-             incomingByte = incomingByte ^ 0x20
-             self.rxExcapeNext = 0
+          # Some other API frame, just dump it
+          continue
 
-#          self.log(0, "mrbee got byte %02X\n" % incomingByte)       
-          
-          self.rxBuffer.append(incomingByte)
-    
-          if len(self.rxBuffer) == 3:
-             self.rxExpectedPktLen = self.rxBuffer[1] * 256 + self.rxBuffer[2] + 4
-
-          if len(self.rxBuffer) == self.rxExpectedPktLen:
-             #self.logger.debug("mrbee - think we may have a packet")                 
-             pktChecksum = 0
-             for i in range(3, self.rxExpectedPktLen):
-                pktChecksum = (pktChecksum + self.rxBuffer[i]) & 0xFF
-                               
-             if 0xFF != pktChecksum:
-                # Error, conintue
-                self.logger.error("mrbee - checksum error - checksum is %02X" % (pktChecksum))
-                continue      
-
-             if 0x80 == self.rxBuffer[3]:
-                # 16 bit addressing
-                pktDataOffset = 14
-             elif 0x81 == self.rxBuffer[3]:
-                # 64 bit addressing
-                pktDataOffset = 8
-             else:
-                # Some other API frame, just dump it
-                self.rxBuffer = [ ]
-                self.rxExcapeNext = 0
-                self.rxProcessing = 0
-
-#                for i in range(0, self.rxExpectedPktLen-1):
-#                   print "Byte %02d: 0x%02X" % (i-pktDataOffset, self.rxBuffer[i])
-             
-             pkt = packet(self.rxBuffer[pktDataOffset + 0], self.rxBuffer[pktDataOffset + 1], self.rxBuffer[pktDataOffset + 5], self.rxBuffer[(pktDataOffset + 6):-1])
-             return pkt
-
-    return None
+       mrbusPkt = frame[pktDataOffset:]
+       if not mrbusCRC.verify(mrbusPkt):
+          self.logger.error("mrbee - MRBus CRC error, dropping packet")
+          continue
+
+       self.rxPkts.append(packet(mrbusPkt[0], mrbusPkt[1], mrbusPkt[5], mrbusPkt[6:mrbusPkt[2]], rxTime))
+
+  def getpkt(self):
+    if len(self.rxPkts) == 0:
+       self.rxPoll()
+    if len(self.rxPkts) == 0:
+       return None
+    return self.rxPkts.popleft()
+
+  def getpkts(self, max_n=None):
+    """Returns a list of every packet received so far, oldest first, up to max_n of them.
+       Anything beyond max_n is kept for the next call."""
+    self.rxPoll()
+    return popPackets(self.rxPkts, max_n)
 
   def getLED(self, ledRefdes):
      if ledRefdes not in self.leds:
@@ -315,150 +349,73 @@ class mrbeeSimple(object):
      return self.leds[ledRefdes]
 
   def setLED(self, ledRefdes, ledState):
-#     if ledState:
-#        state = "On"
-#     else:
-#        state = "Off"
-#     self.log(0, "mrbee - setting XBee LED %d to %s" % (ledNum, state))
-
-     pins = {'D6':2, 'D7':3, 'D8':1, 'D9':0}
-
-     if ledRefdes not in pins:
+     if ledRefdes not in self.LED_PINS:
        return
      if type(ledState) is not bool:
        return
      
      self.leds[ledRefdes] = ledState
-     
-     txBuffer = [ ]
-     txBuffer.append(0x7E)          # 0 - Start 
-     txBuffer.append(0x00)          # 1 - Len MSB
-     txBuffer.append(0x05)          # 2 - Len LSB - five bytes
-     txBuffer.append(0x08)          # 3 - API being called - AT CMD
-     txBuffer.append(0x00)          # 4 - Frame identifier
-     txBuffer.append(0x44)          # 5 - 'D'
-     txBuffer.append(0x30 + pins[ledRefdes]) # 6 - '0'-'4'
-     if ledState is True:
-        txBuffer.append(5)       # 8 - '5' for on
-     else:
-        txBuffer.append(4)       # 8 - '4' for off
-     
-     xbeeChecksum = 0
-     for i in range(3, len(txBuffer)):
-        xbeeChecksum = (xbeeChecksum + txBuffer[i]) & 0xFF
-     xbeeChecksum = (0xFF - xbeeChecksum) & 0xFF;
-     txBuffer.append(xbeeChecksum)     
-
-     txBufferEscaped = [ txBuffer[0] ]
-     escapedChars = frozenset([0x7E, 0x7D, 0x11, 0x13])
-
-     for i in range(1, len(txBuffer)):
-        if txBuffer[i] in escapedChars:
-           txBufferEscaped.append(0x7D)
-           txBufferEscaped.append(txBuffer[i] ^ 0x20)
-        else:
-           txBufferEscaped.append(txBuffer[i])
-
-     self.serial.write(txBufferEscaped)  
+     self.serial.write(self.ledFrames[(ledRefdes, ledState)])
      return   
   
+  def encodeLED(self, ledRefdes, ledState):
+     """Returns the escaped XBee AT command frame that drives an XBee LED pin."""
+     atCmd = bytearray()
+     atCmd.append(0x08)          # 0 - API being called - AT CMD
+     atCmd.append(0x00)          # 1 - Frame identifier
+     atCmd.append(0x44)          # 2 - 'D'
+     atCmd.append(0x30 + self.LED_PINS[ledRefdes]) # 3 - '0'-'4'
+     if ledState is True:
+        atCmd.append(5)       # 4 - '5' for on
+     else:
+        atCmd.append(4)       # 4 - '4' for off
+     return self.txEncoder.encode(atCmd)
 
-  def sendpkt(self, dest, data, src=None):
+  def encodepkt(self, dest, data, src=None):
+     """Returns an MRBus packet wrapped in an escaped XBee transmit frame, ready for sendframe()."""
      if src == None:
         src = self.addr
 
-     txPktLen = 10 + len(data)   # 5 MRBus overhead, 5 XBee, and the data
-
-     txBuffer = [ ]
-     txBuffer.append(0x7E)       # 0 - Start 
-     txBuffer.append(0x00)       # 1 - Len MSB
-     txBuffer.append(txPktLen)   # 2 - Len LSB
-     txBuffer.append(0x01)       # 3 - API being called - transmit by 16 bit address
-     txBuffer.append(0x00)       # 4 - Frame identifier
-     txBuffer.append(0xFF)       # 5 - MSB of dest address - broadcast 0xFFFF
-     txBuffer.append(0xFF)       # 6 - LSB of dest address - broadcast 0xFFFF
-     txBuffer.append(0x00)       # 7 - Transmit Options
+     txPkt = self.txPkt
+     del txPkt[:]
+     txPkt.append(0x01)       # 0 - API being called - transmit by 16 bit address
+     txPkt.append(0x00)       # 1 - Frame identifier
+     txPkt.append(0xFF)       # 2 - MSB of dest address - broadcast 0xFFFF
+     txPkt.append(0xFF)       # 3 - LSB of dest address - broadcast 0xFFFF
+     txPkt.append(0x00)       # 4 - Transmit Options
      
-     txBuffer.append(dest)           # 8 / 0 - Destination
-     txBuffer.append(src)            # 9 / 1 - Source
-     txBuffer.append(len(data) + 5)  # 10/ 2 - Length
-     txBuffer.append(0)              # 11/ 3 - CRC High
-     txBuffer.append(0)              # 12/ 4 - CRC Low
+     txPkt.append(dest)           # 5 / 0 - Destination
+     txPkt.append(src)            # 6 / 1 - Source
+     txPkt.append(len(data) + 5)  # 7 / 2 - Length
+     txPkt.append(0)              # 8 / 3 - CRC Low
+     txPkt.append(0)              # 9 / 4 - CRC High
 
 #     print "MRBee transmitting from %02X to %02X" % (src, dest)
 
-     for b in data:
-        txBuffer.append(int(b) & 0xFF)
+     try:
+        txPkt += bytes(data)
+     except (TypeError, ValueError):
+        txPkt.extend([(ord(b) if type(b) is str else int(b)) & 0xFF for b in data])
 
-     crc = mrbusCRC16Calculate(txBuffer[8:])
-     txBuffer[11] = 0xFF & crc
-     txBuffer[12] = 0xFF & (crc >> 8)
+     crc = mrbusCRC.calculate(memoryview(txPkt)[5:])
+     txPkt[8] = 0xFF & crc
+     txPkt[9] = 0xFF & (crc >> 8)
 
-     xbeeChecksum = 0
-     for i in range(3, len(txBuffer)):
-        xbeeChecksum = (xbeeChecksum + txBuffer[i]) & 0xFF
-     xbeeChecksum = (0xFF - xbeeChecksum) & 0xFF;
-     txBuffer.append(xbeeChecksum)
+     return self.txEncoder.encode(txPkt)
 
-     txBufferEscaped = [ txBuffer[0] ]
-     
-     escapedChars = frozenset([0x7E, 0x7D, 0x11, 0x13])
-
-     for i in range(1, len(txBuffer)):
-        if txBuffer[i] in escapedChars:
-           txBufferEscaped.append(0x7D)
-           txBufferEscaped.append(txBuffer[i] ^ 0x20)
-        else:
-           txBufferEscaped.append(txBuffer[i])
-
-#     print "txBufferEscaped is %d bytes" % (len(txBufferEscaped))
-#     pkt = ""
-#     for i in txBufferEscaped:
-#        pkt = pkt + "%02x " % (i)
-#     print pkt
-     
-     self.serial.write(txBufferEscaped)     
+  def sendframe(self, frame):
+     """Writes a frame previously built by encodepkt()."""
+     self.serial.write(frame)
+
+  def sendpkt(self, dest, data, src=None):
+     self.serial.write(self.encodepkt(dest, data, src))
      
 def mrbusCRC16Calculate(data):
-   mrbusPktLen = data[2]
-   crc = 0
-   
-   for i in range(0, mrbusPktLen):
-      if i == 3 or i == 4:
-         continue
-      else:
-         a = data[i]
-      crc = mrbusCRC16Update(crc, a)
-      
-   return crc
+   return mrbusCRC.calculate(data)
 
 
 def mrbusCRC16Update(crc, a):
-   MRBus_CRC16_HighTable = [ 0x00, 0xA0, 0xE0, 0x40, 0x60, 0xC0, 0x80, 0x20, 0xC0, 0x60, 0x20, 0x80, 0xA0, 0x00, 0x40, 0xE0 ]
-   MRBus_CRC16_LowTable =  [ 0x00, 0x01, 0x03, 0x02, 0x07, 0x06, 0x04, 0x05, 0x0E, 0x0F, 0x0D, 0x0C, 0x09, 0x08, 0x0A, 0x0B ]
-   crc16_h = (crc>>8) & 0xFF
-   crc16_l = crc & 0xFF
-   
-   i = 0
-   
-   while i < 2:
-      if i != 0:
-         w = ((crc16_h << 4) & 0xF0) | ((crc16_h >> 4) & 0x0F)
-         t = (w ^ a) & 0x0F
-      else:
-         t = (crc16_h ^ a) & 0xF0
-         t = ((t << 4) & 0xF0) | ((t >> 4) & 0x0F)
-         
-      crc16_h = (crc16_h << 4) & 0xFF
-      crc16_h = crc16_h | (crc16_l >> 4)
-      crc16_l = (crc16_l << 4) & 0xFF
-      
-      crc16_h = crc16_h ^ MRBus_CRC16_HighTable[t]
-      crc16_l = crc16_l ^ MRBus_CRC16_LowTable[t]
-      
-      i = i + 1
-      
-   return (crc16_h<<8) | crc16_l
+   return mrbusCRC.update(crc, a)
       
 class mrbus(object):
   def disconnect(self):
@@ -527,9 +484,26 @@ class mrbus(object):
   def sendpkt(self, addr, data, src=None):
     self.mrbs.sendpkt(addr, data, src)
 
+  def encodepkt(self, addr, data, src=None):
+    """Returns a packet encoded for the underlying interface.  Packets that never change can be
+       encoded once and sent repeatedly with sendframe()."""
+    return self.mrbs.encodepkt(addr, data, src)
+
+  def sendframe(self, frame):
+    self.mrbs.sendframe(frame)
+
   def getpkt(self):
     return self.mrbs.getpkt()
 
+  def getpkts(self, max_n=None):
+    """Returns every packet already received (up to max_n) as a list, which is empty if there are none.
+       This lets a caller handle a whole burst of packets in one pass."""
+    return self.mrbs.getpkts(max_n)
+
+  def fileno(self):
+    """Returns the serial port's file descriptor, which the bridge registers with its selector."""
+    return self.mrbs.serial.fileno()
+
   def getnode(self, dest):
     return node(self, dest)
 
@@ -558,13 +532,14 @@ class mrbus(object):
       timeout=max(0,timeout)
     self.mrbs.serial.timeout=timeout
     while not done:
-      p = self.getpkt()
-      if p:
+      pkts = self.getpkts()
+      if pkts:
         self.mrbs.serial.timeout=0
-        for hint,h in self.handlers:
-          r = h(p)
-          if r:
-            break
+        for p in pkts:
+          for hint,h in self.handlers:
+            r = h(p)
+            if r:
+              break
       else:
         done=True
     self.mrbs.serial.timeout=to
@@ -0,0 +1,122 @@
+# *************************************************************************
+# Title:    Table-driven CRC16 for MRBus packets
+# Authors:  Michael D. Petersen <railfan@drgw.net>
+#           Nathan D. Holmes <maverick@drgw.net>
+# File:     mrbusCRC.py
+# License:  GNU General Public License v3
+#
+# LICENSE:
+#   Copyright (C) 2018 Michael Petersen & Nathan Holmes
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+# DESCRIPTION:
+#   This module calculates and checks the CRC16 carried in bytes 3 and 4
+#   of every MRBus packet.  The AVR firmware computes the CRC a nibble at a
+#   time with two 16 entry tables; here the same polynomial is expanded once
+#   at import into a 256 entry table so each byte costs a single lookup.
+#
+#   All functions take anything indexable that yields ints - bytes,
+#   bytearray, memoryview or a plain list - laid out as an MRBus packet:
+#     [0] dest  [1] src  [2] len  [3] CRC low  [4] CRC high  [5] cmd  [6..] data
+#
+#   Run this file directly for a benchmark against the nibble-wise version.
+#
+# *************************************************************************
+
+MRBUS_PKT_DEST = 0
+MRBUS_PKT_SRC = 1
+MRBUS_PKT_LEN = 2
+MRBUS_PKT_CRC_L = 3
+MRBUS_PKT_CRC_H = 4
+MRBUS_PKT_TYPE = 5
+
+def crc16UpdateNibble(crc, a):
+   """Reference implementation - the nibble-at-a-time CRC16 update used by the MRBus firmware.
+      Only used to generate the byte table and by the benchmark."""
+   MRBus_CRC16_HighTable = [ 0x00, 0xA0, 0xE0, 0x40, 0x60, 0xC0, 0x80, 0x20, 0xC0, 0x60, 0x20, 0x80, 0xA0, 0x00, 0x40, 0xE0 ]
+   MRBus_CRC16_LowTable =  [ 0x00, 0x01, 0x03, 0x02, 0x07, 0x06, 0x04, 0x05, 0x0E, 0x0F, 0x0D, 0x0C, 0x09, 0x08, 0x0A, 0x0B ]
+   crc16_h = (crc>>8) & 0xFF
+   crc16_l = crc & 0xFF
+
+   i = 0
+
+   while i < 2:
+      if i != 0:
+         w = ((crc16_h << 4) & 0xF0) | ((crc16_h >> 4) & 0x0F)
+         t = (w ^ a) & 0x0F
+      else:
+         t = (crc16_h ^ a) & 0xF0
+         t = ((t << 4) & 0xF0) | ((t >> 4) & 0x0F)
+
+      crc16_h = (crc16_h << 4) & 0xFF
+      crc16_h = crc16_h | (crc16_l >> 4)
+      crc16_l = (crc16_l << 4) & 0xFF
+
+      crc16_h = crc16_h ^ MRBus_CRC16_HighTable[t]
+      crc16_l = crc16_l ^ MRBus_CRC16_LowTable[t]
+
+      i = i + 1
+
+   return (crc16_h<<8) | crc16_l
+
+# The MRBus CRC is an MSB-first CRC16, so feeding a byte into a CRC is the same as
+# shifting the low byte up and XORing in the CRC of (high byte ^ data) followed by zeros.
+CRC16_TABLE = tuple(crc16UpdateNibble(i << 8, 0) for i in range(256))
+
+def update(crc, a):
+   """Feeds one byte into a running MRBus CRC16."""
+   return ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[((crc >> 8) ^ a) & 0xFF]
+
+def calculate(pkt):
+   """Returns the CRC16 of an MRBus packet.  The length is taken from the packet's own length
+      byte and the two CRC bytes themselves are skipped."""
+   table = CRC16_TABLE
+   crc = 0
+   for a in pkt[0:MRBUS_PKT_CRC_L]:
+      crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ a]
+   for a in pkt[MRBUS_PKT_TYPE:pkt[MRBUS_PKT_LEN]]:
+      crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ a]
+   return crc
+
+def verify(pkt):
+   """Returns True if an MRBus packet holds at least a full header, is as long as its own
+      length byte claims and carries a correct CRC16."""
+   pktLen = len(pkt)
+   if pktLen < 6 or pkt[MRBUS_PKT_LEN] < 6 or pkt[MRBUS_PKT_LEN] > pktLen:
+      return False
+   return calculate(pkt) == (pkt[MRBUS_PKT_CRC_L] | (pkt[MRBUS_PKT_CRC_H] << 8))
+
+
+if __name__ == '__main__':
+   import timeit
+
+   # A ProtoThrottle status packet - 0x53 'S' with 9 bytes of data
+   frame = bytearray([ 0xD0, 0x31, 15, 0, 0, 0x53, 0x80, 0x03, 0x15, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00 ])
+   crc = calculate(frame)
+   frame[MRBUS_PKT_CRC_L] = crc & 0xFF
+   frame[MRBUS_PKT_CRC_H] = (crc >> 8) & 0xFF
+
+   def nibbleCalculate(pkt):
+      crc = 0
+      for i in range(0, pkt[MRBUS_PKT_LEN]):
+         if i == MRBUS_PKT_CRC_L or i == MRBUS_PKT_CRC_H:
+            continue
+         crc = crc16UpdateNibble(crc, pkt[i])
+      return crc
+
+   assert nibbleCalculate(frame) == calculate(frame)
+   assert verify(frame) and verify(memoryview(bytes(frame)))
+
+   n = 20000
+   for (name, fn) in (("nibble (old)", nibbleCalculate), ("table", calculate), ("table verify", verify)):
+      t = min(timeit.repeat(lambda: fn(frame), number=n, repeat=5))
+      print("%-14s %9.0f frames/sec  (%.2f us/frame)" % (name, n / t, 1e6 * t / n))
@@ -0,0 +1,73 @@
+# *************************************************************************
+# Title:    Timer queue for the esu-bridge run loop
+# Authors:  Michael D. Petersen <railfan@drgw.net>
+#           Nathan D. Holmes <maverick@drgw.net>
+# File:     timerQueue.py
+# License:  GNU General Public License v3
+#
+# LICENSE:
+#   Copyright (C) 2018 Michael Petersen & Nathan Holmes
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+# DESCRIPTION:
+#   This class keeps a set of named deadlines (status packets, LED
+#   timeouts, server pings, heartbeats) in a heap so the run loop can
+#   sleep in select() until exactly the next one is due.
+#
+# *************************************************************************
+
+import heapq
+
+class TimerQueue:
+   """A set of named one-shot timers.  Scheduling a name that is already pending moves it."""
+
+   def __init__(self):
+      self.heap = [ ]
+      self.deadlines = { }
+
+   def schedule(self, name, when):
+      """Arranges for name to be returned by expired() once time.time() reaches when."""
+      self.deadlines[name] = when
+      heapq.heappush(self.heap, (when, name))
+
+   def cancel(self, name):
+      self.deadlines.pop(name, None)
+
+   def isScheduled(self, name):
+      return name in self.deadlines
+
+   def prune(self):
+      """Discards heap entries left behind by cancel() or a reschedule."""
+      heap = self.heap
+      while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+         heapq.heappop(heap)
+
+   def timeout(self, now):
+      """Returns the number of seconds until the next timer is due (0 if one already is),
+         or None if nothing is scheduled."""
+      self.prune()
+      if len(self.heap) == 0:
+         return None
+      return max(0, self.heap[0][0] - now)
+
+   def expired(self, now):
+      """Removes and returns the names of every timer due at or before now, earliest first."""
+      names = [ ]
+      heap = self.heap
+      while True:
+         self.prune()
+         if len(heap) == 0 or heap[0][0] > now:
+            break
+         (when, name) = heapq.heappop(heap)
+         del self.deadlines[name]
+         names.append(name)
+      return names
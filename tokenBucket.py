@@ -0,0 +1,60 @@
+# *************************************************************************
+# Title:    Token bucket rate limiter for command station traffic
+# Authors:  Michael D. Petersen <railfan@drgw.net>
+#           Nathan D. Holmes <maverick@drgw.net>
+# File:     tokenBucket.py
+# License:  GNU General Public License v3
+#
+# LICENSE:
+#   Copyright (C) 2018 Michael Petersen & Nathan Holmes
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+# DESCRIPTION:
+#   Some command stations (the Digitrax LNWI in particular) fall over if
+#   commands arrive faster than they can pass them on.  This class lets a
+#   burst of commands out at once and then holds the long term rate to
+#   what the server can take, without pacing traffic that's already slow.
+#
+# *************************************************************************
+
+import time
+
+class TokenBucket:
+   """Allows burst commands at once, refilling at rate commands per second."""
+
+   def __init__(self, rate, burst):
+      self.rate = float(rate)
+      self.burst = float(burst)
+      self.tokens = self.burst
+      self.lastFill = time.time()
+
+   def take(self, n=1, now=None):
+      """Spends n tokens and returns how many seconds the caller should wait before sending (0 if it can
+         go right away).  The bucket can go into debt, so a caller that doesn't wait just delays the next one."""
+      if now is None:
+         now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now - self.lastFill) * self.rate)
+      self.lastFill = now
+      self.tokens -= n
+      if self.tokens >= 0:
+         return 0
+      return -self.tokens / self.rate
+
+   def available(self, now=None):
+      """Returns how many whole tokens can be spent right now without waiting, and how many seconds until
+         the next one after that comes in."""
+      if now is None:
+         now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now - self.lastFill) * self.rate)
+      self.lastFill = now
+      whole = max(0, int(self.tokens))
+      return (whole, (whole + 1 - self.tokens) / self.rate)
@@ -25,36 +25,72 @@
 # *************************************************************************
 
 import socket
+import select
 import time
+import tokenBucket
 
 class WiThrottleConnection:
    """A client object to talk to a JMRI WiFi Throttle server or compatible.  
       This class is capable of handling multiple locomotives simultaneously via
       the multithrottle interface and its ability to multiplex throttles."""
 
-   conn = None
-   activeThrottles = { }
-   funcStatus = { }
-   funcUpdated = { }
-   lastUpdate = 0
-   recvData = ""
-   ip = None
-   port = None
-   operatingMode = "JMRI"
-
-   version = ""
-   trackPowerOn = False
-   heartbeatMaxInterval = 10
-   serverName = ""
-   serverID = ""
    WITHROTTLE_RCV_SZ = 4096
+   # Every multithrottle letter a connection can use, so no connection can have more than this many cabs
+   MULTITHROTTLE_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ012345'
+   # Longest we'll hold a cab's commands waiting for the server to send a new locomotive's functions, in seconds
+   WITHROTTLE_ACQUIRE_TIMEOUT = 3
+
+   # Commands per second and burst size each kind of server can take, or None if it keeps up with anything.
+   # The LNWI's burst covers a whole packet's worth of function toggles, which take two commands each.
+   WITHROTTLE_RATE_LIMITS = { 'JMRI':None, 'LNWI':(20.0, 16) }
+
+   # How long to wait for the LNWI to report a toggled function back before trying again, and how many times to try
+   WITHROTTLE_FUNC_CONFIRM_TIMEOUT = 1.0
+   WITHROTTLE_FUNC_TRIES = 3
+
+   # There's no multiple function command in the protocol, so functions are set one at a time
+   supportsFunctionDictSet = False
 
    def __init__(self):
       """Constructor for the object.  Any internal initialization should occur here."""
+      self.conn = None
+      self.ip = None
+      self.port = None
+      self.operatingMode = "JMRI"
+
+      self.version = ""
+      self.trackPowerOn = False
+      self.heartbeatMaxInterval = 10
+      self.serverName = ""
+      self.serverID = ""
+
+      self.activeThrottles = { }
+      self.speedSlots = { }
+      # What the server has told us about the locomotive on each multithrottle letter - its speed, direction
+      # (0=forward, 1=reverse, like everywhere else in the bridge) and functions.  None means not known.
+      self.throttleState = { }
+      # Multithrottle letters whose desired functions need comparing with the server's (LNWI only)
+      self.funcDirty = set()
+      self.acquireState = { }
+      self.acquireQueue = { }
+      self.acquireDeadline = { }
+
+      self.lastUpdate = 0
+      self.rxBuffer = bytearray()
+      # Handlers for each kind of message from the server, by prefix.  Lists of roster entries, turnouts,
+      # routes and consists can be long on a big JMRI layout and the bridge has no use for them.
+      self.rxHandlers = { b'VN':self.rxVersion, b'PP':self.rxTrackPower, b'*':self.rxHeartbeat,
+                          b'N':self.rxServerName, b'U':self.rxServerID, b'M':self.rxMultithrottle,
+                          b'RL':None, b'RC':None, b'PT':None, b'PR':None, b'PF':None, b'PW':None }
+      self.txLimiter = None
+      self.txBuffer = bytearray()
+      self.txCount = 0
+      # Commands from locomotiveEmergencyStop() that go out ahead of everything in txBuffer
+      self.txUrgent = bytearray()
       
-   def connect(self, ip, port, mode="JMRI"):
+   def connect(self, ip, port, mode="JMRI", clientName="ProtoThrottle Bridge"):
       """Since the LNWI only understands a subset of Multithrottle commands, open up a single connection
-         to multiplex everything through."""
+         to multiplex everything through.  clientName is the name and ID the server knows this connection by."""
       if mode == "JMRI":
          self.operatingMode = "JMRI"
       elif mode == "LNWI":
@@ -70,26 +106,40 @@ class WiThrottleConnection:
       """Set the socket timeout relatively large for the initial connect since they take awhile"""
       self.conn.settimeout(5)
       self.conn.connect((self.ip, self.port))
-      self.recvData = ""
-      self.rxtx("NProtoThrottle Bridge\n")
-      self.rxtx("HUProtoThrottle Bridge\n")
+      """From here on, reads only take whatever has already arrived.  Commands are batched before they're
+         written, so there's nothing for Nagle to gain by holding them back."""
+      self.conn.setblocking(False)
+      self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      del self.rxBuffer[:]
+      del self.txBuffer[:]
+      del self.txUrgent[:]
+      self.txCount = 0
+
+      rateLimit = self.WITHROTTLE_RATE_LIMITS.get(self.operatingMode)
+      if rateLimit is None:
+         self.txLimiter = None
+      else:
+         self.txLimiter = tokenBucket.TokenBucket(rateLimit[0], rateLimit[1])
+
+      self.txQueue("N%s\n" % (clientName))
+      self.rxtx("HU%s\n" % (clientName))
       self.activeThrottles = { }
+      self.speedSlots = { }
+      self.acquireState = { }
+      self.acquireQueue = { }
+      self.acquireDeadline = { }
       print("%s Connect: complete" % (self.operatingMode))
-      """Set the timeout for the socket r/w operations small to prevent blocking too long on receives."""
-      self.conn.settimeout(0.01)
 
 
    def disconnect(self):
       print("%s Disconnect: Shutting down %s interface\n" % (self.operatingMode, self.operatingMode))
       """Shut down all throttle socket connections and disconnect from the WiThrottle server in a clean way."""
       for cabID,mtID in self.activeThrottles.items():
-         try:
-           self.rxtx("M%1.1s-*<;>r\n" % (mtID))
-         except:
-           print("In disconnect, write fails, socket must be dead")
-         time.sleep(0.1)
+         self.txQueue("M%1.1s-*<;>r\n" % (mtID))
+      self.txQueue("Q\n")
       try:
-        self.rxtx("Q\n")
+        # The connection is going away, so whatever the rate limiter is still holding back goes now
+        self.txAll(bytes(self.txBuffer))
       except: 
         print("Socket probably went away rudely")
       try:
@@ -97,105 +147,257 @@ class WiThrottleConnection:
       except Exception as e: 
         print("Socket close error", e)
       self.activeThrottles = { }
-      self.recvData = ""
+      self.speedSlots = { }
+      self.acquireState = { }
+      self.acquireQueue = { }
+      self.acquireDeadline = { }
+      del self.rxBuffer[:]
+      del self.txBuffer[:]
+      del self.txUrgent[:]
+      self.txCount = 0
       print("%s Disconnect: Disconnected" % (self.operatingMode))
 
-   def parseIncomingData(self):
+   def parseIncomingData(self, resp):
+      """Adds data received from the server to the receive buffer and handles every complete line in it.
+         Only the new data is searched for line ends, so a long line arriving in pieces isn't rescanned."""
+      rxBuffer = self.rxBuffer
+      scanFrom = len(rxBuffer)
+      rxBuffer += resp
+
       # If there's no carriage returns, we don't have a complete response of any sort yet
-      if '\n' not in self.recvData:
+      end = rxBuffer.find(b'\n', scanFrom)
+      if end < 0:
          return
 
-      responseStrings = self.recvData.split('\n')
+      start = 0
+      while end >= 0:
+         line = rxBuffer[start:end]
+         start = end + 1
+         end = rxBuffer.find(b'\n', start)
+
+         # Most messages are told apart by their first two characters, the rest by the first.  Anything
+         # we don't care about maps to None and is dropped without ever being decoded.
+         prefix = bytes(line[0:2])
+         if prefix in self.rxHandlers:
+            handler = self.rxHandlers[prefix]
+         elif prefix[0:1] in self.rxHandlers:
+            handler = self.rxHandlers[prefix[0:1]]
+         else:
+            resp = line.decode(errors='replace').strip()
+            # No length?  Nothing to do
+            if len(resp) != 0:
+               print("%s RX: Unknown host->client [%s]\n" % (self.operatingMode, resp))
+            continue
 
-      # If there's trailing unfinished data, put it back in the recieve data queue, otherwise clear it
-      if not self.recvData.endswith('\n'):
-         self.recvData = responseStrings.pop()
-      else:
-         self.recvData = ""
+         if handler is not None:
+            handler(line.decode(errors='replace').strip())
 
-      for resp in responseStrings:
-         # Trim whitespace
-         resp = resp.strip()
+      # Put any trailing unfinished line back in the receive buffer
+      del rxBuffer[:start]
 
-         # No length?  Nothing to do
-         if len(resp) == 0:
-            continue
+   def rxVersion(self, resp):  # Protocol version
+      self.version = resp[2:]
 
-         if ('VN' == resp[0:2]):  # Protocol version
-            self.version = resp[2:]
-         elif ('RL' == resp[0:2]):  # Roster List, don't care right now
-            pass
-         elif ('PPA' == resp[0:3]):  # Track Power
-            if resp[3:4] == '1': # Track power on
-               self.trackPowerOn = True
-            elif resp[3:4] == '0':  # Track power off
-               self.trackPowerOn = False
-            elif resp[3:4] == '2': # Track power unknown - assume the best, on...
-               self.trackPowerOn = True
-         elif ('PT' == resp[0:2]):  # Turnout lists, don't care right now
-            pass
-         elif ('PR' == resp[0:2]):  # Route lists, don't care right now
-            pass
-         elif ('*' == resp[0:1]):  # Heartbeat interval
-            try:
-               self.heartbeatMaxInterval = int(resp[1:])
-            except:
-               self.heartbeatMaxInterval = 10
-         elif ('N' == resp[0:1]):  # Host controller name
-            self.serverName = resp[1:]
-         elif ('U' == resp[0:1]):  # Host controller name
-            self.serverID = resp[1:]
-         elif ('M' == resp[0:1]):  # Some sort of multithrottle response - parse this
-            print("%s RX: Multithrottle update [%s]" % (self.operatingMode, resp))
-            try:
-               (throttle,cmd) = resp.split("<;>")
-               if throttle[2:3] == 'S':
-                  # we've asked for somebody else's loco - steal it!
-                  # The format of this undocumented command appears to be:
-                  # MTSLxxxx<;>Lxxxx
-                  # And the response to steal it is the same
-                  print("%s RX: Cab [%s] needs to steal locomotive [%s]\n" % (self.operatingMode, throttle[1:2], cmd))
-                  cmdStr = resp
-                  self.conn.sendall(cmdStr)
-                  
-               elif throttle[2:3] == "A":
-                  if cmd[0:1] == 'F':
-                     funcNum = int(cmd[2:])
-                     funcVal = int(cmd[1:2])
-                     self.funcStatus[throttle[1:2]][funcNum] = funcVal
-                     print("%s RX: Cab [%s] set func %d to %d " % (self.operatingMode, throttle[1:2], funcNum, funcVal))
-                     if funcNum == 28:
-                        self.funcUpdated[throttle[1:2]] = True
-                  
-            except:
-               print("%s RX: Multithrottle packet exception" % (self.operatingMode))
-               
-         else:
-            print("%s RX: Unknown host->client [%s]\n" % (self.operatingMode, resp))
+   def rxTrackPower(self, resp):
+      if resp[2:3] != 'A':
+         return
+      if resp[3:4] == '1': # Track power on
+         self.trackPowerOn = True
+      elif resp[3:4] == '0':  # Track power off
+         self.trackPowerOn = False
+      elif resp[3:4] == '2': # Track power unknown - assume the best, on...
+         self.trackPowerOn = True
+
+   def rxHeartbeat(self, resp):  # Heartbeat interval
+      try:
+         self.heartbeatMaxInterval = int(resp[1:])
+      except:
+         self.heartbeatMaxInterval = 10
 
+   def rxServerName(self, resp):  # Host controller name
+      self.serverName = resp[1:]
+
+   def rxServerID(self, resp):  # Host controller ID
+      self.serverID = resp[1:]
+
+   def rxMultithrottle(self, resp):  # Some sort of multithrottle response - parse this
+      print("%s RX: Multithrottle update [%s]" % (self.operatingMode, resp))
+      try:
+         (throttle,cmd) = resp.split("<;>")
+         if throttle[2:3] == 'S':
+            # we've asked for somebody else's loco - steal it!
+            # The format of this undocumented command appears to be:
+            # MTSLxxxx<;>Lxxxx
+            # And the response to steal it is the same
+            print("%s RX: Cab [%s] needs to steal locomotive [%s]\n" % (self.operatingMode, throttle[1:2], cmd))
+            cmdStr = resp + "\n"
+            self.txAll(str.encode(cmdStr))
+
+         elif throttle[2:3] == "+":
+            # The server has given us the locomotive, its function states come next
+            self.acquireAdvance(throttle[1:2], 'functions')
+            
+         elif throttle[2:3] == "A":
+            state = self.throttleState.get(throttle[1:2])
+            if state is None:
+               return
+            if cmd[0:1] == 'F':
+               funcNum = int(cmd[2:])
+               funcVal = int(cmd[1:2])
+               state['funcs'][funcNum] = funcVal
+               print("%s RX: Cab [%s] set func %d to %d " % (self.operatingMode, throttle[1:2], funcNum, funcVal))
+               self.functionConfirm(throttle[1:2], state, funcNum, funcVal)
+               self.acquireAdvance(throttle[1:2], 'functions')
+               if funcNum == 28:
+                  self.acquireAdvance(throttle[1:2], 'ready')
+            elif cmd[0:1] == 'V':
+               speed = int(cmd[1:])
+               # A negative speed is an emergency stop, which any new speed has to override
+               if speed < 0:
+                  speed = None
+               state['speed'] = speed
+            elif cmd[0:1] == 'R':
+               # Direction is 0=REV, 1=FWD on WiThrottle
+               state['dir'] = [1,0][int(cmd[1:2])]
+            
+      except:
+         print("%s RX: Multithrottle packet exception" % (self.operatingMode))
 
    def rxtx(self, cmdStr):
-      """Internal shared function for transacting with the WiThrottle server."""
+      """Internal shared function for transacting with the WiThrottle server.  Sends cmdStr, if any, along with
+         anything already queued, and then handles whatever the server has sent without waiting for more.
+         Anything the rate limiter holds back goes out with a later flush()."""
       if cmdStr is not None:
-         self.lastUpdate = time.time()
-         print("%s TX: Sending [%s]" % (self.operatingMode, cmdStr[:-1]))
-         self.conn.sendall(str.encode(cmdStr))
-         time.sleep(0.05)
-      try:
-         self.recvData += self.conn.recv(self.WITHROTTLE_RCV_SZ).decode()
-      except socket.timeout:
-         pass
-      self.parseIncomingData()
+         self.txQueue(cmdStr)
+      self.txFlush()
+
+      while True:
+         try:
+            resp = self.conn.recv(self.WITHROTTLE_RCV_SZ)
+         except (BlockingIOError, InterruptedError):
+            break
+         if len(resp) == 0:
+            raise Exception("%s server closed the connection" % (self.operatingMode))
+         self.parseIncomingData(resp)
+
+   def txQueue(self, cmdStr):
+      """Internal function that adds a command to the outbound buffer.  Nothing is written until txFlush()."""
+      print("%s TX: Sending [%s]" % (self.operatingMode, cmdStr[:-1]))
+      self.txBuffer += str.encode(cmdStr)
+      self.txCount += 1
+
+   def txFlush(self):
+      """Internal function that writes as many queued commands as the rate limiter allows in one go.  The rest
+         stay queued, and it returns how many seconds until the limiter lets more out (0 if nothing's left)."""
+      self.txUrgentFlush()
+      if self.txCount == 0:
+         return 0
+      count = self.txCount
+      delay = 0
+      if self.txLimiter is not None:
+         (count, delay) = self.txLimiter.available()
+         if count == 0:
+            return delay
+         count = min(count, self.txCount)
+         self.txLimiter.take(count)
+      # Commands are whole lines, so the first count of them end at the count'th newline
+      end = 0
+      for i in range(0, count):
+         end = self.txBuffer.index(b"\n", end) + 1
+      self.lastUpdate = time.time()
+      data = bytes(self.txBuffer[:end])
+      del self.txBuffer[:end]
+      self.txCount -= count
+      self.txAll(data)
+      if self.txCount == 0:
+         return 0
+      return delay
+
+   def txAll(self, data):
+      """Internal function that writes all of data to the non-blocking socket.  Commands are tiny, so this only
+         has to wait if the server has stopped reading altogether."""
+      while len(data):
+         try:
+            sent = self.conn.send(data)
+            data = data[sent:]
+         except (BlockingIOError, InterruptedError):
+            (readable, writable, errored) = select.select([], [ self.conn ], [], 5)
+            if len(writable) == 0:
+               raise Exception("%s server stopped accepting commands" % (self.operatingMode))
+
+   def txUrgentFlush(self):
+      """Internal function that writes any urgent commands straight away, without waiting on the rate limiter.
+         They're still counted against it, so the commands behind them wait a little longer instead."""
+      if len(self.txUrgent) == 0:
+         return
+      data = bytes(self.txUrgent)
+      del self.txUrgent[:]
+      if self.txLimiter is not None:
+         self.txLimiter.take(data.count(b"\n"))
+      self.txAll(data)
+
+   def fileno(self):
+      """Returns the socket's file descriptor.  WiThrottlePool.filenos() collects one from each connection."""
+      return self.conn.fileno()
+
+   def filenos(self):
+      """Returns this connection's one file descriptor, in the same form as WiThrottlePool.filenos()."""
+      return [ self.fileno() ]
 
    def getAvailableMultithrottleLetter(self):
-      mtLetters = set('ABCDEFGHIJKLMNOPQRSTUVWXYZ012345')
+      mtLetters = set(self.MULTITHROTTLE_LETTERS)
       usedMTLetters = set(self.activeThrottles.values())
       mtLetters = mtLetters.difference(usedMTLetters)
       return mtLetters.pop()
 
+   def acquireAdvance(self, throttleLetter, newState):
+      """Internal function that moves the acquisition of the locomotive on a multithrottle letter along, from
+         'requested' to 'functions' (the server has started sending its function states) to 'ready'.  Once it's
+         ready, everything the cab asked for in the meantime is sent."""
+      for (cabID, mtID) in self.activeThrottles.items():
+         if mtID == throttleLetter:
+            break
+      else:
+         return
+
+      state = self.acquireState.get(cabID)
+      if state is None or state == 'ready' or state == newState:
+         return
+      self.acquireState[cabID] = newState
+      if newState != 'ready':
+         return
+
+      print("%s Acquire: Cab 0x%02X ready, sending %d held commands" % (self.operatingMode, cabID, len(self.acquireQueue[cabID])))
+      self.acquireDeadline.pop(cabID, None)
+
+      # Turn on track power if it's off for some reason
+      if self.trackPowerOn == False:
+         self.txQueue("PPA1\n")
+
+      held = self.acquireQueue.pop(cabID)
+      for (fn, args) in held:
+         fn(*args)
+
+   def acquireHold(self, cabID, fn, *args):
+      """Internal function that, if cabID's locomotive is still being acquired, saves a call to make once it's
+         ready and returns True.  Returns False if the call can go ahead now."""
+      if self.acquireState.get(cabID, 'ready') == 'ready':
+         return False
+      self.acquireQueue[cabID].append((fn, args))
+      return True
+
+   def acquireExpire(self, now):
+      """Internal function that gives up waiting for function states from any locomotive that's taken too long
+         to send them, so its cab isn't held forever."""
+      for (cabID, deadline) in list(self.acquireDeadline.items()):
+         if deadline <= now:
+            print("%s Acquire: Cab 0x%02X never got function status, carrying on without it" % (self.operatingMode, cabID))
+            self.acquireAdvance(self.activeThrottles[cabID], 'ready')
+
    def locomotiveObjectGet(self, locoNum, cabID, isLongAddress=True):
       """Acquires and returns a handle that will be used to control a locomotive address.  This will release
-         any locomotive that cabID was previously controlling."""
+         any locomotive that cabID was previously controlling.  This doesn't wait for the server - the cab's
+         commands are held until the server has handed over the locomotive and sent its function states."""
       print("%s locomotiveObjectGet(%d, 0x%02X)" % (self.operatingMode, locoNum, cabID))
 
       if cabID not in self.activeThrottles:
@@ -205,11 +407,19 @@ class WiThrottleConnection:
 
       objID = {'addr':cabID, 'locoNum':locoNum, 'isLong':isLongAddress }
 
-      self.funcStatus[self.activeThrottles[cabID]] = [0] * 29  # Array of 29 zeros for function status
-      self.funcUpdated[self.activeThrottles[cabID]] = False
+      # 'desired' and 'pending' are only used by the LNWI function reconciliation - see functionsReconcile()
+      self.throttleState[self.activeThrottles[cabID]] = { 'speed':None, 'dir':None, 'funcs':[0] * 29,
+                                                          'desired':[None] * 29, 'pending':{ } }
+
+      # A speed still queued for the old locomotive mustn't go to the new one
+      self.speedSlots.pop(cabID, None)
+
+      self.acquireState[cabID] = 'requested'
+      self.acquireQueue[cabID] = [ ]
+      self.acquireDeadline[cabID] = time.time() + self.WITHROTTLE_ACQUIRE_TIMEOUT
       
       #Drop anything this cab might have had before.  If nothing, no harm
-      self.rxtx("M%1.1s-*<;>r\n" % (self.activeThrottles[objID['addr']]))
+      self.txQueue("M%1.1s-*<;>r\n" % (self.activeThrottles[objID['addr']]))
 
       if objID['isLong']:
          # Acquire new locomotive at long address
@@ -217,34 +427,43 @@ class WiThrottleConnection:
       else:
          self.rxtx("M%1.1s+S%d<;>S%d\n" % (self.activeThrottles[objID['addr']], objID['locoNum'], objID['locoNum']))
 
-      for i in range(0,50):
-         self.rxtx(None)
-         # Check if we've gotten the function statuses from the command station yet
-         if self.funcUpdated[self.activeThrottles[cabID]] is True:
-            print("%s locomotiveObjectGet: Got func status for [%d] from LNWI" % (self.operatingMode, locoNum))
-            break
-         time.sleep(0.01)
-
-      # Turn on track power if it's off for some reason
-      if self.trackPowerOn == False:
-         self.rxtx("PPA1\n")
-
       return objID
          
    def locomotiveFunctionsGet(self, objID):
+      """Returns the locomotive's function states as the server reported them, or None if they haven't all arrived yet."""
       print("%s locomotiveFunctionsGet(%d)" % (self.operatingMode, objID['locoNum']))
+      if self.acquireState.get(objID['addr']) != 'ready':
+         return None
       throttleLetter = self.activeThrottles[objID['addr']]
-      return self.funcStatus[throttleLetter]
+      return list(self.throttleState[throttleLetter]['funcs'])
          
    def locomotiveEmergencyStop(self, objID):
       """Issues an emergency stop command to a locomotive handle that has been previously acquired with locomotiveObjectGet()."""
       print("%s locomotiveEmergencyStop(%d)" % (self.operatingMode, objID['locoNum']))
-      self.rxtx("M%1.1sA*<;>X\n" % self.activeThrottles[objID['addr']])
+      # Never held back while the locomotive is being acquired - the server handles commands in order, so the
+      # stop applies as soon as it has handed the locomotive over, where waiting on its function states could
+      # hold the stop up for WITHROTTLE_ACQUIRE_TIMEOUT.
+      # Never suppressed either, and any speed still waiting to go out is older than the stop
+      throttleLetter = self.activeThrottles[objID['addr']]
+      self.speedSlots.pop(objID['addr'], None)
+      self.throttleState[throttleLetter]['speed'] = None
+      speedCmd = str.encode("M%1.1sA*<;>V" % throttleLetter)
+      if speedCmd in self.txBuffer:
+         lines = [ line for line in bytes(self.txBuffer).splitlines(True) if not line.startswith(speedCmd) ]
+         self.txBuffer[:] = b"".join(lines)
+         self.txCount = len(lines)
+
+      # It goes out now, ahead of everything else waiting, without waiting on the rate limiter
+      cmdStr = "M%1.1sA*<;>X\n" % throttleLetter
+      print("%s TX: Sending [%s] ahead of %d queued commands" % (self.operatingMode, cmdStr[:-1], self.txCount))
+      self.txUrgent += str.encode(cmdStr)
+      self.txUrgentFlush()
 
    # For the purposes of this function, direction of 0=forward, 1=reverse
    def locomotiveSpeedSet(self, objID, speed, direction=0):
       """Sets the speed and direction of a locomotive via a handle that has been previously acquired with locomotiveObjectGet().  
-         Speed is 0-127, Direction is 0=forward, 1=reverse."""
+         Speed is 0-127, Direction is 0=forward, 1=reverse.  The setting waits in the cab's slot until flush(),
+         and replaces anything already there, so a burst of changes only sends the last one."""
       speed = int(speed)
       direction = int(direction)
 
@@ -257,11 +476,42 @@ class WiThrottleConnection:
       if speed >= 127 or speed < 0:
          speed = 0
 
-      self.rxtx("M%1.1sA*<;>V%d\n" % (self.activeThrottles[objID['addr']], speed))
-      # Direction is 0=REV, 1=FWD on WiThrottle
-      self.rxtx("M%1.1sA*<;>R%d\n" % (self.activeThrottles[objID['addr']], [1,0][direction]))
+      self.speedSlots[objID['addr']] = (speed, direction)
+
+   def locomotiveSpeedSend(self, cabID):
+      """Internal function that sends whatever speed and direction is waiting in a cab's slot.  Only the parts
+         that differ from what the server last reported are sent."""
+      if cabID not in self.speedSlots:
+         return
+      (speed, direction) = self.speedSlots.pop(cabID)
+      state = self.throttleState[self.activeThrottles[cabID]]
+      if state['speed'] != speed:
+         self.txQueue("M%1.1sA*<;>V%d\n" % (self.activeThrottles[cabID], speed))
+         state['speed'] = speed
+      if state['dir'] != direction:
+         # Direction is 0=REV, 1=FWD on WiThrottle
+         self.txQueue("M%1.1sA*<;>R%d\n" % (self.activeThrottles[cabID], [1,0][direction]))
+         state['dir'] = direction
+
+   def flush(self):
+      """Sends the speed and direction waiting in each cab's slot, along with every other command queued since
+         the last flush, in a single write.  Should be called once all of a burst of throttle packets has been handled.
+         Returns how many seconds until the rate limiter lets out anything it held back, or 0 if everything went,
+         and the caller should call flush() again then."""
+      for cabID in list(self.speedSlots.keys()):
+         # Speeds for a locomotive that's still being acquired stay in the slot until it's ready
+         if self.acquireState.get(cabID, 'ready') == 'ready':
+            self.locomotiveSpeedSend(cabID)
+      if len(self.funcDirty):
+         now = time.time()
+         for throttleLetter in self.funcDirty:
+            self.functionsReconcile(throttleLetter, now)
+         self.funcDirty.clear()
+      return self.txFlush()
    
    def locomotiveFunctionSet(self, objID, funcNum, funcVal):
+      if self.acquireHold(objID['addr'], self.locomotiveFunctionSet, objID, funcNum, funcVal):
+         return
       if self.operatingMode == "LNWI":
          self.locomotiveFunctionSetLNWI(objID, funcNum, funcVal)
       else:
@@ -274,12 +524,17 @@ class WiThrottleConnection:
       # Thankfully, JMRI supports the "force function" ('f') command as described in the spec
       # so we can avoid all the nasties as we have in LNWI mode
       print("JMRI locomotiveFunctionSet(%d): set func %d to %d" % (objID['locoNum'], funcNum, funcVal))
-      
-      self.rxtx("M%1.1sA*<;>f%d%d\n" % (self.activeThrottles[objID['addr']], funcVal, funcNum))   
+
+      funcs = self.throttleState[self.activeThrottles[objID['addr']]]['funcs']
+      if funcs[funcNum] == funcVal:
+         return
+      self.txQueue("M%1.1sA*<;>f%d%d\n" % (self.activeThrottles[objID['addr']], funcVal, funcNum))
+      funcs[funcNum] = funcVal
    
    def locomotiveFunctionSetLNWI(self, objID, funcNum, funcVal):
       """Sets or clears a function on a locomotive via a handle that has been previously acquired with locomotiveObjectGet().  
-         funcNum is 0-28 for DCC, funcVal is 0 or 1."""
+         funcNum is 0-28 for DCC, funcVal is 0 or 1.  This only records what the function should be - the commands
+         to get it there are worked out by functionsReconcile() when the connection is next flushed."""
 
       # This is the nasty part.  The LNWI doesn't support the "force function" ('f') command, so we have to do 
       # weird crap here to actually get the function in the state we want.
@@ -288,16 +543,94 @@ class WiThrottleConnection:
       funcVal = int(funcVal)
 
       print("LNWI locomotiveFunctionSet(%d): set func %d to %d" % (objID['locoNum'], funcNum, funcVal))
- 
-      if funcNum == 2:  # 2 is non-latching, all others are latching
-         self.rxtx("M%1.1sA*<;>F%d%d\n" % (self.activeThrottles[objID['addr']], funcVal, funcNum))
+
+      throttleLetter = self.activeThrottles[objID['addr']]
+
+      # 2 is non-latching, so it's always passed straight on - a horn press the LNWI didn't act on, or that got
+      # out of step with what it reports, mustn't be lost to the reconciliation below
+      if funcNum == 2:
+         self.txQueue("M%1.1sA*<;>F%d%d\n" % (throttleLetter, funcVal, funcNum))
+         return
+
+      state = self.throttleState[throttleLetter]
+      if state['desired'][funcNum] != funcVal:
+         state['desired'][funcNum] = funcVal
+         # A new request gets its own full set of tries
+         if funcNum in state['pending']:
+            state['pending'][funcNum][1] = 0
+      self.funcDirty.add(throttleLetter)
+
+   def functionsReconcile(self, throttleLetter, now):
+      """Internal function that compares the functions a throttle wants with what the LNWI last reported and queues
+         the fewest commands that will bring them into line.  All of a packet's changes end up in the same write.
+         A toggle that's been sent but not yet reported back is left alone until the report arrives or it times out,
+         so nothing gets toggled twice by mistake."""
+      state = self.throttleState.get(throttleLetter)
+      if state is None:
+         return
+      desired = state['desired']
+      funcs = state['funcs']
+      pending = state['pending']
+
+      for funcNum in range(0, 29):
+         if desired[funcNum] is None:
+            continue
+
+         if funcNum in pending:
+            (deadline, tries) = pending[funcNum]
+            if deadline > now:
+               continue   # Still waiting to hear back
+            del pending[funcNum]
+         else:
+            tries = 0
+
+         if desired[funcNum] == funcs[funcNum]:
+            desired[funcNum] = None
+            continue
+
+         if tries >= self.WITHROTTLE_FUNC_TRIES:
+            print("LNWI functionsReconcile: Cab [%s] func %d never changed, giving up" % (throttleLetter, funcNum))
+            desired[funcNum] = None
+            continue
+
+         # Everything but the non-latching 2, which never gets here, is latching
+         self.txQueue("M%1.1sA*<;>F1%d\n" % (throttleLetter, funcNum))
+         self.txQueue("M%1.1sA*<;>F0%d\n" % (throttleLetter, funcNum))
+         pending[funcNum] = [ now + self.WITHROTTLE_FUNC_CONFIRM_TIMEOUT, tries + 1 ]
+
+   def functionConfirm(self, throttleLetter, state, funcNum, funcVal):
+      """Internal function called for every function state the server reports.  If it answers a toggle we sent
+         and the function still isn't what the throttle wants, the toggle is tried again on the next flush."""
+      if funcNum not in state['pending']:
+         return
+      if state['desired'][funcNum] is None or state['desired'][funcNum] == funcVal:
+         del state['pending'][funcNum]
+         state['desired'][funcNum] = None
       else:
-         if self.funcStatus[ self.activeThrottles[ objID['addr'] ] ] [funcNum] != funcVal:
-            self.rxtx("M%1.1sA*<;>F1%d\n" % (self.activeThrottles[objID['addr']], funcNum) )
-            self.rxtx("M%1.1sA*<;>F0%d\n" % (self.activeThrottles[objID['addr']], funcNum) )
+         # Make it due now, keeping the count of tries
+         state['pending'][funcNum][0] = 0
+         self.funcDirty.add(throttleLetter)
+
+   def functionsExpire(self, now):
+      """Internal function that arranges another look at any toggle the LNWI hasn't reported back in time."""
+      for (throttleLetter, state) in self.throttleState.items():
+         for (deadline, tries) in state['pending'].values():
+            if deadline <= now:
+               self.funcDirty.add(throttleLetter)
+               break
 
    def locomotiveDisconnect(self, objID):
       print("%s locomotiveDisconnect(%d): disconnect" % (self.operatingMode, objID['locoNum']))
+      # Whatever the cab last asked for (usually a stop) has to reach the locomotive before it's released,
+      # unless the server never finished handing it over
+      if self.acquireState.get(objID['addr'], 'ready') == 'ready':
+         self.locomotiveSpeedSend(objID['addr'])
+      self.speedSlots.pop(objID['addr'], None)
+      self.acquireState.pop(objID['addr'], None)
+      self.acquireQueue.pop(objID['addr'], None)
+      self.acquireDeadline.pop(objID['addr'], None)
+      self.throttleState.pop(self.activeThrottles[objID['addr']], None)
+      self.funcDirty.discard(self.activeThrottles[objID['addr']])
       self.rxtx("M%1.1s-*<;>r\n" % (self.activeThrottles[objID['addr']]))
       del self.activeThrottles[objID['addr']]
 
@@ -309,9 +642,86 @@ class WiThrottleConnection:
       if heartbeatInterval < 1:
          heartbeatInterval = 1
 
-      if time.time() > self.lastUpdate + heartbeatInterval:
+      # Anything still held back by the rate limiter will do as a heartbeat once it goes
+      if time.time() > self.lastUpdate + heartbeatInterval and self.txCount == 0:
          self.rxtx("*\n")
       else:
          self.rxtx(None)
 
+      # Anything that came in may have finished acquiring a locomotive, releasing the commands its cab was holding
+      self.acquireExpire(time.time())
+      self.functionsExpire(time.time())
+      return self.flush()
 
+
+class WiThrottlePool:
+   """Several WiThrottleConnections to the same server, looking like a single one to the rest of the bridge.
+      Each connection only has 32 multithrottle letters, so cabs are spread across the connections as they
+      show up, which lets one bridge run more than 32 cabs and splits the protocol work between sockets."""
+
+   supportsFunctionDictSet = WiThrottleConnection.supportsFunctionDictSet
+
+   def __init__(self, poolSize=1):
+      self.poolSize = max(1, int(poolSize))
+      self.conns = [ ]
+      self.cabConns = { }
+
+   def connect(self, ip, port, mode="JMRI"):
+      self.conns = [ ]
+      self.cabConns = { }
+      for i in range(0, self.poolSize):
+         conn = WiThrottleConnection()
+         if i == 0:
+            conn.connect(ip, port, mode)
+         else:
+            # The server tells clients apart by name, so every connection needs its own
+            conn.connect(ip, port, mode, "ProtoThrottle Bridge %d" % (i + 1))
+            # They all end up at the same server, so they all draw from the same rate limit
+            conn.txLimiter = self.conns[0].txLimiter
+         self.conns.append(conn)
+
+   def disconnect(self):
+      for conn in self.conns:
+         conn.disconnect()
+      self.cabConns = { }
+
+   def connectionForCab(self, cabID):
+      """Internal function that returns the connection cabID's throttle lives on, picking the least busy one
+         with a free multithrottle letter for a cab we haven't seen before."""
+      if cabID in self.cabConns:
+         return self.cabConns[cabID]
+
+      conn = min(self.conns, key=lambda c: len(c.activeThrottles))
+      if len(conn.activeThrottles) >= len(conn.MULTITHROTTLE_LETTERS):
+         raise Exception("%s: No multithrottle letters left on any of %d connections" % (conn.operatingMode, len(self.conns)))
+      self.cabConns[cabID] = conn
+      return conn
+
+   def locomotiveObjectGet(self, locoNum, cabID, isLongAddress=True):
+      return self.connectionForCab(cabID).locomotiveObjectGet(locoNum, cabID, isLongAddress)
+
+   def locomotiveFunctionsGet(self, objID):
+      return self.cabConns[objID['addr']].locomotiveFunctionsGet(objID)
+
+   def locomotiveEmergencyStop(self, objID):
+      self.cabConns[objID['addr']].locomotiveEmergencyStop(objID)
+
+   def locomotiveSpeedSet(self, objID, speed, direction=0):
+      self.cabConns[objID['addr']].locomotiveSpeedSet(objID, speed, direction)
+
+   def locomotiveFunctionSet(self, objID, funcNum, funcVal):
+      self.cabConns[objID['addr']].locomotiveFunctionSet(objID, funcNum, funcVal)
+
+   def locomotiveDisconnect(self, objID):
+      self.cabConns.pop(objID['addr']).locomotiveDisconnect(objID)
+
+   def flush(self):
+      delays = [ conn.flush() for conn in self.conns ]
+      return min([ delay for delay in delays if delay > 0 ] or [ 0 ])
+
+   def filenos(self):
+      return [ conn.fileno() for conn in self.conns ]
+
+   def update(self):
+      delays = [ conn.update() for conn in self.conns ]
+      return min([ delay for delay in delays if delay > 0 ] or [ 0 ])
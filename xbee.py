@@ -0,0 +1,194 @@
+# *************************************************************************
+# Title:    XBee API mode framing for MRBee
+# Authors:  Michael D. Petersen <railfan@drgw.net>
+#           Nathan D. Holmes <maverick@drgw.net>
+# File:     xbee.py
+# License:  GNU General Public License v3
+#
+# LICENSE:
+#   Copyright (C) 2018 Michael Petersen & Nathan Holmes
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+# DESCRIPTION:
+#   This module handles the escaped API mode (AP=2) framing the XBee uses
+#   on its serial port.  A frame on the wire looks like:
+#     0x7E  len MSB  len LSB  <len bytes of API data>  checksum
+#   with 0x7E, 0x7D, 0x11 and 0x13 after the start byte sent as 0x7D
+#   followed by the byte XORed with 0x20.
+#
+#   It has no dependency on pySerial so the framing can be exercised on
+#   its own; mrbus.mrbeeSimple feeds it whatever the serial port returns
+#   and writes whatever XBeeFrameEncoder hands back.
+#
+#   Run this file directly for a benchmark of the frame encoder.
+#
+# *************************************************************************
+
+import logging
+import re
+
+XBEE_START = 0x7E
+XBEE_ESCAPE = 0x7D
+XBEE_XON = 0x11
+XBEE_XOFF = 0x13
+
+# Every byte that has to be escaped, mapped to its two byte replacement
+XBEE_ESCAPES = dict((bytes([b]), bytes([XBEE_ESCAPE, b ^ 0x20])) for b in (XBEE_START, XBEE_ESCAPE, XBEE_XON, XBEE_XOFF))
+XBEE_ESCAPE_RE = re.compile(b'[\x7e\x7d\x11\x13]')
+
+def escapeMatch(m):
+   return XBEE_ESCAPES[m.group()]
+
+def escape(data):
+   """Returns data as bytes with the four reserved bytes escaped.  The scan runs in C and only
+      calls back into Python for bytes that actually need escaping, which is rare."""
+   return XBEE_ESCAPE_RE.sub(escapeMatch, data)
+
+def unescape(data):
+   """Returns the bytes of data with any XBee escape sequences removed.  A trailing
+      escape byte with nothing after it is dropped."""
+   data = bytes(data)
+   if XBEE_ESCAPE not in data:
+      return data
+   parts = data.split(b'\x7d')
+   unescaped = bytearray(parts[0])
+   for part in parts[1:]:
+      if len(part) == 0:
+         continue
+      unescaped.append(part[0] ^ 0x20)
+      unescaped += part[1:]
+   return bytes(unescaped)
+
+class XBeeFrameParser(object):
+   """Incremental parser for escaped XBee API frames.  Raw serial data is handed to feed() in
+      whatever sized pieces it arrives, and every complete frame with a good checksum is
+      returned as bytes (API identifier followed by the frame data, checksum removed).
+      Partial frames are held until the rest arrives."""
+
+   def __init__(self, logger=None):
+      self.rxBuffer = bytearray()
+      self.logger = logger
+      if logger is None:
+         self.logger = logging.getLogger('mrbus')
+
+   def reset(self):
+      del self.rxBuffer[:]
+
+   def feed(self, data):
+      """Adds raw serial bytes to the parser and returns a list of any frames completed by them."""
+      frames = []
+      rxBuffer = self.rxBuffer
+      rxBuffer += data
+
+      while len(rxBuffer):
+         # Anything before a start byte isn't part of a frame
+         start = rxBuffer.find(XBEE_START)
+         if start < 0:
+            del rxBuffer[:]
+            break
+         if start > 0:
+            del rxBuffer[:start]
+
+         # 0x7E never appears escaped inside a frame, so the next one bounds this frame
+         end = rxBuffer.find(XBEE_START, 1)
+         if end < 0:
+            frame = unescape(rxBuffer[1:])
+         else:
+            frame = unescape(rxBuffer[1:end])
+
+         if len(frame) >= 2:
+            frameLen = (frame[0] << 8) + frame[1]
+            frameComplete = (len(frame) >= frameLen + 3)
+         else:
+            frameComplete = False
+
+         if not frameComplete:
+            if end < 0:
+               break   # Wait for more data
+            self.logger.error("mrbee - truncated frame, %d bytes dropped" % (end))
+            del rxBuffer[:end]
+            continue
+
+         # Anything after a complete frame but before the next start byte is noise
+         if end < 0:
+            del rxBuffer[:]
+         else:
+            del rxBuffer[:end]
+
+         # API data plus checksum sums to 0xFF
+         pktChecksum = sum(frame[2:frameLen + 3]) & 0xFF
+         if 0xFF != pktChecksum:
+            self.logger.error("mrbee - checksum error - checksum is %02X" % (pktChecksum))
+            continue
+
+         frames.append(frame[2:frameLen + 2])
+
+      return frames
+
+
+class XBeeFrameEncoder(object):
+   """Builds escaped XBee API frames ready to write to the serial port.  The unescaped frame is
+      assembled in a bytearray that is reused from call to call."""
+
+   def __init__(self):
+      self.txBuffer = bytearray()
+
+   def encode(self, apiData):
+      """Wraps apiData (API identifier followed by the frame data) in an XBee frame and returns it as bytes."""
+      txBuffer = self.txBuffer
+      apiLen = len(apiData)
+      del txBuffer[:]
+      txBuffer.append(0xFF & (apiLen >> 8))  # Len MSB
+      txBuffer.append(0xFF & apiLen)         # Len LSB
+      txBuffer += apiData
+      txBuffer.append(0xFF - (sum(apiData) & 0xFF))
+      # The start byte is the only one that isn't escaped
+      return b'\x7e' + escape(txBuffer)
+
+
+if __name__ == '__main__':
+   import timeit
+
+   # A broadcast transmit request carrying a 'v' version packet from the bridge
+   apiData = bytes([ 0x01, 0x00, 0xFF, 0xFF, 0x00,
+                     0xFF, 0xD0, 19, 0x13, 0x7E, 0x76, 0x80, 0x12, 0x34, 0x56, 0x01, 0x00,
+                     0x45, 0x53, 0x55, 0x45, 0x4E, 0x45, 0x54 ])
+
+   def listEncode(apiData):
+      # The way mrbeeSimple used to build frames - one list append per byte
+      txBuffer = [ 0x7E, 0x00, len(apiData) ]
+      for b in apiData:
+         txBuffer.append(int(b) & 0xFF)
+      xbeeChecksum = 0
+      for i in range(3, len(txBuffer)):
+         xbeeChecksum = (xbeeChecksum + txBuffer[i]) & 0xFF
+      xbeeChecksum = (0xFF - xbeeChecksum) & 0xFF;
+      txBuffer.append(xbeeChecksum)
+
+      txBufferEscaped = [ txBuffer[0] ]
+      escapedChars = frozenset([0x7E, 0x7D, 0x11, 0x13])
+      for i in range(1, len(txBuffer)):
+         if txBuffer[i] in escapedChars:
+            txBufferEscaped.append(0x7D)
+            txBufferEscaped.append(txBuffer[i] ^ 0x20)
+         else:
+            txBufferEscaped.append(txBuffer[i])
+      return txBufferEscaped
+
+   encoder = XBeeFrameEncoder()
+   assert bytes(listEncode(apiData)) == encoder.encode(apiData)
+   assert XBeeFrameParser().feed(encoder.encode(apiData)) == [ apiData ]
+
+   n = 20000
+   for (name, fn) in (("list (old)", listEncode), ("encoder", encoder.encode)):
+      t = min(timeit.repeat(lambda: fn(apiData), number=n, repeat=5))
+      print("%-12s %6.2f us/frame" % (name, 1e6 * t / n))